@@ -0,0 +1,171 @@
+import numpy as np
+from django.conf import settings
+
+from nest_app.models import OrderedItem, ship_orders
+
+
+class PendingDemand:
+    """Pending ordered items of a set of products as parallel arrays, one row per item, oldest first"""
+
+    def __init__(self, rows, blocked_orders=()):
+        self.item_ids = []
+        order_codes = {}
+        product_codes = {}
+        order_index = []
+        product_index = []
+        needed = []
+        for item_id, order_id, product_id, quantity, shipped_quantity in rows:
+            self.item_ids.append(item_id)
+            order_index.append(order_codes.setdefault(order_id, len(order_codes)))
+            product_index.append(product_codes.setdefault(product_id, len(product_codes)))
+            needed.append(quantity - shipped_quantity)
+
+        self.order_ids = list(order_codes)
+        self.product_ids = list(product_codes)
+        self.order_index = np.array(order_index, dtype=np.int64)
+        self.product_index = np.array(product_index, dtype=np.int64)
+        self.needed = np.array(needed, dtype=np.int64)
+        # orders that also wait on products outside this demand, so cannot complete from it
+        self.blocked = np.array([order_id in blocked_orders for order_id in self.order_ids], dtype=bool)
+
+    @classmethod
+    def load(cls, product_ids):
+        """Read the pending items of product_ids, and which of their orders wait on other products, in two queries"""
+
+        product_ids = [str(product_id) for product_id in product_ids]
+        pending = OrderedItem.objects.filter(product_id__in=product_ids).pending()
+        rows = pending.values_list("id", "order_id", "product_id", "quantity", "shipped_quantity")
+        blocked_orders = set(
+            OrderedItem.objects.pending().filter(order_id__in=pending.values("order_id"))
+            .exclude(product_id__in=product_ids).order_by().values_list("order_id", flat=True)
+        )
+        return cls(rows, blocked_orders)
+
+    def __len__(self):
+        return len(self.item_ids)
+
+    def totals(self):
+        """Quantity needed per product id"""
+        totals = np.bincount(self.product_index, weights=self.needed, minlength=len(self.product_ids))
+        return {product_id: int(total) for product_id, total in zip(self.product_ids, totals)}
+
+
+class AllocationPlan:
+    """Quantity allocated to every row of a PendingDemand"""
+
+    def __init__(self, demand, quantities):
+        self.demand = demand
+        self.quantities = quantities
+
+    def allocations(self):
+        """(item_id, order_id, product_id, quantity) for every item that gets stock, oldest item first"""
+
+        demand = self.demand
+        rows = np.flatnonzero(self.quantities)
+        # plain lists, indexing arrays one element at a time is far slower
+        columns = zip(rows.tolist(), demand.order_index[rows].tolist(), demand.product_index[rows].tolist(),
+                      self.quantities[rows].tolist())
+        return [
+            (demand.item_ids[row], demand.order_ids[order], demand.product_ids[product], quantity)
+            for row, order, product, quantity in columns
+        ]
+
+    def allocated(self):
+        """Quantity allocated per product id"""
+        demand = self.demand
+        totals = np.bincount(demand.product_index, weights=self.quantities, minlength=len(demand.product_ids))
+        return {product_id: int(total) for product_id, total in zip(demand.product_ids, totals)}
+
+
+def fifo(demand):
+    """Oldest item first"""
+    return []
+
+
+def smallest_first(demand):
+    """Items needing the least first, so the most items are filled"""
+    return [demand.needed]
+
+
+def max_completed_orders(demand):
+    """Orders that can complete from this stock first, those needing the least in total before the rest
+
+    Each order's items sit together in every product's queue, so stock goes to whole orders rather than being
+    spread over many.
+    """
+
+    outstanding = np.bincount(demand.order_index, weights=demand.needed, minlength=len(demand.order_ids))
+    return [demand.blocked[demand.order_index], outstanding[demand.order_index], demand.order_index]
+
+
+POLICIES = {
+    "fifo": fifo,
+    "smallest_first": smallest_first,
+    "max_completed_orders": max_completed_orders,
+}
+
+
+def get_policy(name=None):
+    if name is None:
+        name = getattr(settings, "NEST_ALLOCATION_POLICY", "fifo")
+    if name not in POLICIES:
+        raise ValueError(f"Unknown allocation policy {name}")
+    return POLICIES[name]
+
+
+def allocate(demand, available, policy=None):
+    """Allocate available stock (quantity per product id) to the demand in one vectorized pass
+
+    Rows are ordered by product, then by the policy's keys (most significant first), then by age. Each row gets
+    whatever of its product's stock the rows ahead of it in the same product leave, up to what it needs.
+    """
+
+    if not len(demand):
+        return AllocationPlan(demand, demand.needed.copy())
+
+    keys = get_policy(policy)(demand)
+    age = np.arange(len(demand))
+    # np.lexsort sorts by its last key first
+    order = np.lexsort([age] + keys[::-1] + [demand.product_index])
+
+    product_index = demand.product_index[order]
+    needed = demand.needed[order]
+    ahead = np.cumsum(needed) - needed
+    group_start = np.searchsorted(product_index, product_index, side="left")
+    ahead -= ahead[group_start]
+
+    stock = np.array([available.get(product_id, 0) for product_id in demand.product_ids], dtype=np.int64)
+    quantities = np.empty_like(needed)
+    quantities[order] = np.clip(stock[product_index] - ahead, 0, needed)
+    return AllocationPlan(demand, quantities)
+
+
+def consolidated():
+    """True when a restock packs each order's freed items together rather than shipping every item on its own"""
+    return getattr(settings, "NEST_RESTOCK_SHIPMENTS", "consolidated") == "consolidated"
+
+
+def write_plan(plan, consolidate=None):
+    """Ship every allocation of the plan, loading the items in one query
+
+    Consolidated, the items freed for one order across all products are packed into as few shipments as
+    possible; otherwise each item is packed on its own. consolidate defaults to NEST_RESTOCK_SHIPMENTS.
+    """
+
+    if consolidate is None:
+        consolidate = consolidated()
+
+    allocations = plan.allocations()
+    items = OrderedItem.objects.select_related("order").in_bulk([item_id for item_id, _, _, _ in allocations])
+
+    orders = {}
+    order_allocations = {} if consolidate else []
+    for item_id, order_id, _, quantity in allocations:
+        item = items[item_id]
+        # one instance per order keeps its in-memory counters right across its items
+        item.order = orders.setdefault(order_id, item.order)
+        if consolidate:
+            order_allocations.setdefault(order_id, (item.order, []))[1].append((item, quantity))
+        else:
+            order_allocations.append((item.order, [(item, quantity)]))
+    ship_orders(order_allocations.values() if consolidate else order_allocations)
@@ -4,4 +4,11 @@ from django.apps import AppConfig
 class NestAppConfig(AppConfig):
     name = 'nest_app'
 
+    def ready(self):
+        from django.db.backends.signals import connection_created
 
+        # registers the inventory cache invalidation signal handlers
+        from nest_app import inventory  # noqa: F401
+        from nest_app.db import apply_storage_profile
+
+        connection_created.connect(apply_storage_profile, dispatch_uid="nest_app_storage_profile")
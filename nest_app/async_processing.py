@@ -0,0 +1,56 @@
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+from nest_app.processing import plan_order, process_order, process_orders, process_restock, submit_order
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Process-wide pool of NEST_DB_THREADS threads that every async view runs its database work on
+
+    However many requests are waiting, no more than this many database connections are open at once.
+    """
+
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, "NEST_DB_THREADS", 8),
+                thread_name_prefix="nest-db"
+            )
+        return _executor
+
+
+def database_sync_to_async(func):
+    """Async version of func, run on the database thread pool
+
+    Pool threads keep their connections between calls, so stale ones are closed before and after each call
+    the way Django does around a request.
+    """
+
+    def run(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await sync_to_async(run, thread_sensitive=False, executor=get_executor())(*args, **kwargs)
+
+    return wrapper
+
+
+process_order_async = database_sync_to_async(process_order)
+submit_order_async = database_sync_to_async(submit_order)
+process_orders_async = database_sync_to_async(process_orders)
+process_restock_async = database_sync_to_async(process_restock)
+plan_order_async = database_sync_to_async(plan_order)
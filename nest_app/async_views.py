@@ -0,0 +1,105 @@
+import json
+
+from django.db import IntegrityError
+from django.http import JsonResponse
+
+from . import idempotency, models
+from .async_processing import database_sync_to_async, process_restock_async, submit_order_async
+from .processing import REQUEST_ERRORS, request_error_detail
+from .serializers import ProductInventorySerializer, OrdersSerializer, OrderRequestSerializer, RestockItemSerializer
+
+# rows per page of the async list endpoints, unless page_size asks for fewer or more up to the maximum
+ASYNC_PAGE_SIZE = 100
+ASYNC_MAX_PAGE_SIZE = 1000
+
+
+def csrf_exempt(view):
+    # django.views.decorators.csrf.csrf_exempt wraps the view in a sync function, which would hide a coroutine
+    view.csrf_exempt = True
+    return view
+
+
+@csrf_exempt
+async def orders(request):
+    """GET a page of orders, or POST an order; database work runs on the database thread pool"""
+
+    if request.method == "GET":
+        return await _list_response(request, models.Order.objects.all(), OrdersSerializer)
+    if request.method != "POST":
+        return _method_not_allowed(request)
+
+    order_request = OrderRequestSerializer(data=_json_body(request))
+    if not order_request.is_valid():
+        return JsonResponse(order_request.errors, status=400)
+
+    try:
+        entry, replayed = await submit_order_async(order_request.validated_data, request.headers.get("Idempotency-Key"))
+    except REQUEST_ERRORS as e:
+        return JsonResponse({"detail": request_error_detail(e)}, status=400)
+    except IntegrityError:
+        return JsonResponse({"detail": "Order already exists."}, status=409)
+
+    return JsonResponse(entry.result, status=entry.status_code, headers=idempotency.replay_headers(replayed))
+
+
+@csrf_exempt
+async def inventory(request):
+    """GET a page of inventory, or POST a restock; database work runs on the database thread pool"""
+
+    if request.method == "GET":
+        return await _list_response(request, models.ProductInventory.objects.all(), ProductInventorySerializer)
+    if request.method != "POST":
+        return _method_not_allowed(request)
+
+    restock_request = RestockItemSerializer(data=_json_body(request), many=True, allow_empty=False)
+    if not restock_request.is_valid():
+        return JsonResponse(restock_request.errors, status=400, safe=False)
+
+    try:
+        inventory_products = await process_restock_async(restock_request.validated_data)
+    except REQUEST_ERRORS as e:
+        return JsonResponse({"detail": request_error_detail(e)}, status=400)
+
+    return JsonResponse(ProductInventorySerializer(inventory_products, many=True).data, safe=False)
+
+
+def list_page(queryset, serializer_class, after, page_size):
+    """One page of queryset by primary key after the id after, serialized, and the id the next page starts after"""
+
+    if after is not None:
+        queryset = queryset.filter(id__gt=after)
+    rows = list(queryset.order_by("id")[:page_size + 1])
+    next_after = rows[page_size - 1].id if len(rows) > page_size else None
+    return serializer_class(rows[:page_size], many=True).data, next_after
+
+
+list_page_async = database_sync_to_async(list_page)
+
+
+async def _list_response(request, queryset, serializer_class):
+    try:
+        page_size = min(int(request.GET.get("page_size", ASYNC_PAGE_SIZE)), ASYNC_MAX_PAGE_SIZE)
+    except ValueError:
+        page_size = 0
+    if page_size < 1:
+        return JsonResponse({"detail": "Invalid page size."}, status=400)
+
+    results, next_after = await list_page_async(queryset, serializer_class, request.GET.get("after"), page_size)
+    next_url = None
+    if next_after is not None:
+        query = request.GET.copy()
+        query["after"] = next_after
+        next_url = request.build_absolute_uri(f"{request.path}?{query.urlencode()}")
+    return JsonResponse({"next": next_url, "results": results})
+
+
+def _json_body(request):
+    try:
+        return json.loads(request.body)
+    except ValueError:
+        # the serializer reports the body as invalid
+        return None
+
+
+def _method_not_allowed(request):
+    return JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=405)
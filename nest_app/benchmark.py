@@ -0,0 +1,239 @@
+import json
+import math
+import random
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+from nest_app import idempotency, inventory
+from nest_app.models import (
+    FulfillmentTask, IdempotencyRecord, InventoryMovement, InventorySnapshot, Order, OrderedItem, Product,
+    ProductInventory, Shipment, ShippedItem,
+    MAX_SHIPMENT_MASS, ship_package
+)
+from nest_app.processing import init_catalog, process_order, process_orders, process_restock
+
+MASS_DISTRIBUTIONS = ("catalog", "uniform", "lognormal")
+
+
+class QueryCounter:
+    """connection.execute_wrapper counting queries without keeping them, so it is cheap at any scale"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class OperationStats:
+    def __init__(self):
+        self.latencies = []
+        self.queries = 0
+        self.units = 0
+
+    @contextmanager
+    def measure(self, counter, units=1):
+        """Time one call handling units items (orders for process_orders) and count its queries"""
+
+        queries_before = counter.count
+        start = time.perf_counter()
+        yield
+        self.latencies.append(time.perf_counter() - start)
+        self.queries += counter.count - queries_before
+        self.units += units
+
+    def summary(self):
+        """Throughput in units per second, queries and latency percentiles per call"""
+
+        if not self.latencies:
+            return None
+        total = sum(self.latencies)
+        latencies = sorted(self.latencies)
+        calls = len(latencies)
+        return {
+            "calls": calls,
+            "per_sec": round(self.units / total, 1) if total else None,
+            "queries_per_call": round(self.queries / calls, 2),
+            "queries_per_unit": round(self.queries / self.units, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        }
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of already sorted values"""
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def generate_catalog(base_catalog, skus, mass_distribution, rng):
+    """Synthetic catalog of skus products modelled on base_catalog (test_inventory.json format)"""
+
+    if mass_distribution not in MASS_DISTRIBUTIONS:
+        raise ValueError(f"Unknown mass distribution {mass_distribution}")
+
+    masses = [product["mass_g"] for product in base_catalog]
+    log_masses = [math.log(mass) for mass in masses]
+    log_mean = sum(log_masses) / len(log_masses)
+    log_std = math.sqrt(sum((m - log_mean) ** 2 for m in log_masses) / len(log_masses))
+
+    catalog = []
+    for index in range(skus):
+        base = base_catalog[index % len(base_catalog)]
+        if mass_distribution == "catalog":
+            mass = base["mass_g"]
+        elif mass_distribution == "uniform":
+            mass = rng.randint(min(masses), max(masses))
+        else:
+            mass = round(rng.lognormvariate(log_mean, log_std))
+        catalog.append({
+            "product_id": index,
+            "product_name": f"{base['product_name']} #{index}",
+            # every product has to fit in a package on its own
+            "mass_g": max(1, min(mass, MAX_SHIPMENT_MASS - 1)),
+        })
+    return catalog
+
+
+def sku_weights(skus, skew):
+    """Zipf weights: the product at rank i is ordered in proportion to 1 / (i + 1) ** skew"""
+    return [1 / (rank + 1) ** skew for rank in range(skus)]
+
+
+def generate_orders(count, skus, skew, max_lines, max_quantity, rng, first_order_id=0):
+    weights = sku_weights(skus, skew)
+    product_ids = list(range(skus))
+    for order_id in range(first_order_id, first_order_id + count):
+        lines = rng.randint(1, max_lines)
+        chosen = set(rng.choices(product_ids, weights=weights, k=lines))
+        yield {
+            "order_id": order_id,
+            "requested": [{"product_id": product_id, "quantity": rng.randint(1, max_quantity)} for product_id in chosen],
+        }
+
+
+def generate_restock(skus, quantity):
+    return [{"product_id": product_id, "quantity": quantity} for product_id in range(skus)]
+
+
+def reset_tables():
+    for model in (ShippedItem, Shipment, FulfillmentTask, IdempotencyRecord, OrderedItem, Order, InventoryMovement,
+                  InventorySnapshot, ProductInventory, Product):
+        model.objects.all().delete()
+    inventory.invalidate()
+    idempotency.clear()
+
+
+def run_scale(orders, base_catalog, skus=13, skew=1.0, mass_distribution="catalog", max_lines=3, max_quantity=4,
+              restock_every=100, restock_quantity=None, batch_size=1, ship_packages=100, seed=0):
+    """Drive process_order(s), process_restock and ship_package against a fresh catalog; returns the report
+
+    Orders are fed one at a time with process_order, or in batches with process_orders when batch_size > 1.
+    Every restock_every orders all products are restocked, by default with enough stock for the orders
+    in between on average.
+    """
+
+    rng = random.Random(seed)
+    reset_tables()
+    init_catalog(generate_catalog(base_catalog, skus, mass_distribution, rng))
+    if restock_quantity is None:
+        restock_quantity = max(1, restock_every * max_lines * (max_quantity + 1) // (2 * skus))
+
+    counter = QueryCounter()
+    order_stats = OperationStats()
+    restock_stats = OperationStats()
+    ship_stats = OperationStats()
+
+    start = time.perf_counter()
+    with connection.execute_wrapper(counter):
+        stream = generate_orders(orders, skus, skew, max_lines, max_quantity, rng)
+        processed = 0
+        while processed < orders:
+            if processed % restock_every == 0:
+                with restock_stats.measure(counter):
+                    process_restock(generate_restock(skus, restock_quantity))
+
+            size = min(batch_size, orders - processed, restock_every - processed % restock_every)
+            chunk = [next(stream) for _ in range(size)]
+            with order_stats.measure(counter, units=size):
+                if batch_size > 1:
+                    process_orders(chunk)
+                else:
+                    process_order(chunk[0])
+            processed += size
+
+        product = Product.objects.order_by("mass_g").first()
+        for _ in range(ship_packages):
+            package = {"order_id": 0, "shipped": [{"product_id": product.id, "quantity": 1}]}
+            with ship_stats.measure(counter):
+                ship_package(package)
+    elapsed = time.perf_counter() - start
+
+    order_summary = order_stats.summary()
+    return {
+        "orders": orders,
+        "elapsed_s": round(elapsed, 3),
+        "orders_per_sec": order_summary["per_sec"],
+        "queries_per_order": order_summary["queries_per_unit"],
+        "shipments": Shipment.objects.count(),
+        "operations": {
+            "process_order" if batch_size == 1 else "process_orders": order_summary,
+            "process_restock": restock_stats.summary(),
+            "ship_package": ship_stats.summary(),
+        },
+    }
+
+
+# metrics compared against a baseline, and whether a higher value is better
+COMPARED_METRICS = {
+    "orders_per_sec": True,
+    "queries_per_order": False,
+}
+COMPARED_OPERATION_METRICS = {
+    "per_sec": True,
+    "queries_per_call": False,
+    "p50_ms": False,
+    "p95_ms": False,
+    "p99_ms": False,
+}
+
+
+def compare(report, baseline, tolerance):
+    """List (scale, metric, baseline, current, change) for every metric worse than baseline by over tolerance"""
+
+    regressions = []
+
+    def check(scale, name, higher_is_better, old, new):
+        if old is None or new is None or old == 0:
+            return
+        change = (new - old) / old
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            regressions.append((scale, name, old, new, round(change * 100, 1)))
+
+    for scale, result in report["results"].items():
+        old_result = baseline.get("results", {}).get(scale)
+        if old_result is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            check(scale, metric, higher_is_better, old_result.get(metric), result.get(metric))
+        for operation, stats in result["operations"].items():
+            old_stats = old_result["operations"].get(operation)
+            if not stats or not old_stats:
+                continue
+            for metric, higher_is_better in COMPARED_OPERATION_METRICS.items():
+                check(scale, f"{operation}.{metric}", higher_is_better, old_stats.get(metric), stats.get(metric))
+    return regressions
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(report, path):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
@@ -0,0 +1,97 @@
+import json
+import re
+from itertools import islice
+
+from django.db import transaction
+
+from nest_app import inventory
+from nest_app.models import Product, ProductInventory
+from nest_app.products import catalog_changed
+
+# products read, compared and written per transaction
+CATALOG_CHUNK_SIZE = 1000
+
+_SEPARATORS = re.compile(r"[\s,]*")
+
+
+def iter_catalog(path, read_size=64 * 1024):
+    """Yield the products of a catalog file one at a time, reading it read_size characters at a time
+
+    The file is either a JSON array of products (test_inventory.json format) or one product object per line.
+    """
+
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        buffer, position, eof, started = "", 0, False, False
+        while True:
+            position = _SEPARATORS.match(buffer, position).end()
+            if position < len(buffer):
+                if not started:
+                    started = True
+                    if buffer[position] == "[":
+                        position += 1
+                        continue
+                elif buffer[position] == "]":
+                    return
+                try:
+                    product, position = decoder.raw_decode(buffer, position)
+                except ValueError:
+                    # the product runs on past the end of the buffer, unless the file has ended
+                    if eof:
+                        raise
+                else:
+                    yield product
+                    continue
+            elif eof:
+                return
+            chunk = f.read(read_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+
+
+def load_catalog(products, chunk_size=CATALOG_CHUNK_SIZE):
+    """Upsert products, and an empty inventory row for each new one, in bulk chunks
+
+    Re-loading the same catalog writes nothing, and stock of products already loaded is never touched.
+    Returns how many products were created, updated and left unchanged.
+    """
+
+    counts = {"created": 0, "updated": 0, "unchanged": 0}
+    products = iter(products)
+    for chunk in iter(lambda: list(islice(products, chunk_size)), []):
+        with transaction.atomic():
+            _load_chunk(chunk, counts)
+    inventory.invalidate()
+    if counts["created"] or counts["updated"]:
+        catalog_changed.send(sender=Product)
+    return counts
+
+
+def _load_chunk(chunk, counts):
+    # keyed by id so a product listed twice is written once, with its last entry
+    incoming = {}
+    for product in chunk:
+        product_id = str(product["product_id"])
+        incoming[product_id] = Product(id=product_id, name=product["product_name"], mass_g=product["mass_g"])
+
+    existing = Product.objects.in_bulk(list(incoming))
+    created, changed = [], []
+    for product_id, product in incoming.items():
+        current = existing.get(product_id)
+        if current is None:
+            created.append(product)
+        elif (current.name, current.mass_g) != (product.name, product.mass_g):
+            changed.append(product)
+
+    Product.objects.bulk_create(created)
+    Product.objects.bulk_update(changed, ["name", "mass_g"])
+
+    stocked = set(ProductInventory.objects.filter(product_id__in=list(incoming)).values_list("product_id", flat=True))
+    ProductInventory.objects.bulk_create([
+        ProductInventory(product_id=product_id, snapshot_quantity=0) for product_id in incoming if product_id not in stocked
+    ])
+
+    counts["created"] += len(created)
+    counts["updated"] += len(changed)
+    counts["unchanged"] += len(incoming) - len(created) - len(changed)
@@ -0,0 +1,52 @@
+import functools
+import random
+import time
+
+from django.conf import settings
+from django.db import OperationalError, connection
+
+LOCK_RETRY_ATTEMPTS = 5
+LOCK_RETRY_BASE_DELAY = 0.02
+
+
+def is_locked_error(error):
+    return isinstance(error, OperationalError) and "locked" in str(error).lower()
+
+
+def retry_on_locked(func):
+    """Retry func with exponential backoff and full jitter while the database reports it is locked
+
+    Inside an atomic block the error is re-raised straight away: only the whole transaction can be retried,
+    which is left to a retry_on_locked around the outermost unit of work.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(LOCK_RETRY_ATTEMPTS):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if not is_locked_error(e) or connection.in_atomic_block or attempt == LOCK_RETRY_ATTEMPTS - 1:
+                    raise
+                time.sleep(random.uniform(0, LOCK_RETRY_BASE_DELAY * 2 ** attempt))
+
+    return wrapper
+
+
+def storage_profile():
+    """Return the PRAGMA settings selected by NEST_STORAGE_PROFILE, a profile name or a dict of PRAGMAs"""
+
+    profile = getattr(settings, "NEST_STORAGE_PROFILE", None)
+    if isinstance(profile, str):
+        return getattr(settings, "NEST_STORAGE_PROFILES", {})[profile]
+    return profile or {}
+
+
+def apply_storage_profile(sender, connection, **kwargs):
+    """connection_created handler tuning every new SQLite connection with the configured storage profile"""
+
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in storage_profile().items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
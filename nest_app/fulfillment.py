@@ -0,0 +1,87 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from nest_app import inventory, shipment_log
+from nest_app.db import retry_on_locked
+from nest_app.models import FulfillmentTask
+from nest_app.processing import allocate_order, unit_of_work
+
+MAX_ATTEMPTS = 5
+
+
+def claim_timeout():
+    return timedelta(seconds=getattr(settings, "NEST_FULFILLMENT_CLAIM_TIMEOUT", 300))
+
+
+def release_stale_tasks():
+    """Put tasks claimed by a worker that died before finishing them back in the outbox"""
+
+    return FulfillmentTask.objects.filter(
+        status=FulfillmentTask.PROCESSING,
+        updated_at__lt=timezone.now() - claim_timeout()
+    ).update(status=FulfillmentTask.PENDING, updated_at=timezone.now())
+
+
+def claim_tasks(batch_size):
+    """Claim up to batch_size pending tasks, oldest first, skipping any another worker claimed first"""
+
+    claimed = []
+    pending = FulfillmentTask.objects.filter(status=FulfillmentTask.PENDING).order_by("id")
+    for task_id in pending.values_list("id", flat=True)[:batch_size]:
+        # the status guard makes the claim atomic across worker processes
+        if FulfillmentTask.objects.filter(id=task_id, status=FulfillmentTask.PENDING) \
+                .update(status=FulfillmentTask.PROCESSING, updated_at=timezone.now()):
+            claimed.append(task_id)
+    return claimed
+
+
+@retry_on_locked
+def run_task(task):
+    """Allocate stock to the pending items of the task's order and ship them, in one unit of work"""
+
+    with unit_of_work():
+        order = task.order
+        allocate_order(order, order.items.pending())
+        FulfillmentTask.objects.filter(id=task.id) \
+            .update(status=FulfillmentTask.DONE, updated_at=timezone.now())
+
+
+def drain_outbox(batch_size=100):
+    """Fulfill one batch of pending outbox tasks, returning how many were claimed"""
+
+    task_ids = claim_tasks(batch_size)
+    for task in FulfillmentTask.objects.select_related("order").filter(id__in=task_ids).order_by("id"):
+        try:
+            run_task(task)
+        except Exception as e:
+            attempts = task.attempts + 1
+            FulfillmentTask.objects.filter(id=task.id).update(
+                status=FulfillmentTask.PENDING if attempts < MAX_ATTEMPTS else FulfillmentTask.FAILED,
+                attempts=attempts,
+                last_error=str(e) or e.__class__.__name__,
+                updated_at=timezone.now()
+            )
+    return len(task_ids)
+
+
+def run_worker(batch_size=100, poll_interval=1.0, once=False):
+    """Drain the outbox until it is empty (once) or forever, returning how many tasks were claimed"""
+
+    total = 0
+    try:
+        while True:
+            release_stale_tasks()
+            claimed = drain_outbox(batch_size)
+            total += claimed
+            if claimed == 0:
+                # an idle worker folds the inventory ledger into snapshots
+                inventory.snapshot_if_due()
+                if once:
+                    return total
+                time.sleep(poll_interval)
+    finally:
+        # pool workers exit without running atexit handlers, so write out buffered shipment records here
+        shipment_log.close()
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from nest_app.models import IdempotencyRecord
+from nest_app.serializers import OrdersSerializer
+
+Entry = namedtuple("Entry", ["fingerprint", "status_code", "result"])
+
+# key -> Entry, least recently used first so it is the first dropped when the index is full
+_entries = OrderedDict()
+_lock = threading.Lock()
+
+
+def cache_size():
+    return getattr(settings, "NEST_IDEMPOTENCY_CACHE_SIZE", 10000)
+
+
+def request_key(order_id, client_key=None):
+    """Key of an order request: the client's Idempotency-Key when it sent one, the order id otherwise"""
+    return f"request:{client_key}" if client_key else f"order:{order_id}"
+
+
+def fingerprint(order):
+    """Stable hash of order json, the same for ids passed as numbers or strings"""
+
+    normalized = {
+        "order_id": str(order["order_id"]),
+        "requested": [
+            {"product_id": str(item["product_id"]), "quantity": int(item["quantity"])} for item in order["requested"]
+        ],
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+def lookup(key):
+    """Entry recorded for key, from memory or with one primary key query, or None for a new request"""
+
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            _entries.move_to_end(key)
+            return entry
+
+    record = IdempotencyRecord.objects.filter(key=key).first()
+    if record is None:
+        return None
+    entry = Entry(record.fingerprint, record.status_code, record.result)
+    _remember_in_memory([(key, entry)])
+    return entry
+
+
+def lookup_many(keys):
+    """{key: Entry} for the keys already recorded, reading the ones not in memory in one query"""
+
+    found = {}
+    with _lock:
+        for key in keys:
+            entry = _entries.get(key)
+            if entry is not None:
+                _entries.move_to_end(key)
+                found[key] = entry
+
+    missing = [key for key in keys if key not in found]
+    if missing:
+        loaded = [
+            (record.key, Entry(record.fingerprint, record.status_code, record.result))
+            for record in IdempotencyRecord.objects.filter(key__in=missing)
+        ]
+        _remember_in_memory(loaded)
+        found.update(loaded)
+    return found
+
+
+def replay(key, order):
+    """Entry recorded for key when order repeats the request it was recorded for, or None for a new request
+
+    A key recorded for a different request raises IntegrityError, as creating the order again would.
+    """
+    return replay_many([key], [order]).get(key)
+
+
+def replay_many(keys, orders):
+    """{key: Entry} for the keys, one per order, whose order was already recorded; see replay
+
+    An order sent with a client key it was not recorded under is still found by its order id.
+    """
+
+    order_keys = [request_key(order["order_id"]) for order in orders]
+    entries = lookup_many(list(dict.fromkeys(keys + order_keys)))
+    found = {}
+    for key, order_key, order in zip(keys, order_keys, orders):
+        entry = entries.get(key) or entries.get(order_key)
+        if entry is None:
+            continue
+        if entry.fingerprint != fingerprint(order):
+            raise IntegrityError("Order already exists.")
+        found[key] = entry
+    return found
+
+
+def replay_headers(replayed):
+    """Response headers marking a replayed result"""
+    return {"Idempotent-Replayed": "true"} if replayed else None
+
+
+def record(keyed_orders):
+    """Record (key, order json, order object) results inside the transaction that created the orders
+
+    A result recorded under a client's key is recorded under its order id's key too, so the order sent
+    again without that key is still replayed. The in-memory index only learns about them once that
+    transaction commits.
+    """
+
+    results = []
+    entries = []
+    records = []
+    for key, order, order_obj in keyed_orders:
+        entry = Entry(fingerprint(order), 201, dict(OrdersSerializer(order_obj).data))
+        results.append(entry)
+        for entry_key in dict.fromkeys([key, request_key(order_obj.id)]):
+            entries.append((entry_key, entry))
+            records.append(IdempotencyRecord(
+                key=entry_key,
+                fingerprint=entry.fingerprint,
+                order=order_obj,
+                status_code=entry.status_code,
+                result=entry.result
+            ))
+    IdempotencyRecord.objects.bulk_create(records)
+    transaction.on_commit(lambda: _remember_in_memory(entries))
+    return results
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+
+
+def _remember_in_memory(entries):
+    with _lock:
+        for key, entry in entries:
+            _entries[key] = entry
+            _entries.move_to_end(key)
+        while len(_entries) > cache_size():
+            _entries.popitem(last=False)
@@ -0,0 +1,58 @@
+import os
+import threading
+import time
+
+# Crockford base32, as used by ULIDs: sorts the same way as the numbers it encodes
+ENCODING = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+RANDOM_BITS = 80
+RANDOM_MAX = (1 << RANDOM_BITS) - 1
+
+_lock = threading.Lock()
+_last_ms = 0
+_last_random = 0
+
+
+def _reset_after_fork():
+    # a forked worker must not keep incrementing the random part it inherited from its parent
+    global _last_ms, _last_random, _lock
+    _lock = threading.Lock()
+    _last_ms = 0
+    _last_random = 0
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _encode(value, length):
+    chars = []
+    for _ in range(length):
+        value, index = divmod(value, 32)
+        chars.append(ENCODING[index])
+    return "".join(reversed(chars))
+
+
+def new_id():
+    """Return a 26 character time-ordered ULID-style id
+
+    The first 48 bits are the millisecond timestamp, so ids sort in creation order and append to the end of
+    primary key indexes. The remaining 80 bits are random, which keeps ids from separate worker processes
+    apart without coordination. Ids made in the same millisecond by this process increment the random part
+    instead of drawing a new one, so they stay strictly increasing.
+    """
+
+    global _last_ms, _last_random
+
+    with _lock:
+        now_ms = time.time_ns() // 1_000_000
+        if now_ms > _last_ms:
+            _last_ms = now_ms
+            _last_random = int.from_bytes(os.urandom(10), "big") >> 1
+        elif _last_random < RANDOM_MAX:
+            _last_random += 1
+        else:
+            # random part exhausted within one millisecond, borrow the next one
+            _last_ms += 1
+            _last_random = int.from_bytes(os.urandom(10), "big") >> 1
+        value = (_last_ms << RANDOM_BITS) | _last_random
+
+    return _encode(value, 26)
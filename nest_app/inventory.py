@@ -0,0 +1,231 @@
+import threading
+import weakref
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, F, Max, OuterRef, Subquery, Sum
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from nest_app.db import retry_on_locked
+from nest_app.models import InventoryMovement, InventorySnapshot, Product, ProductInventory, movements_since_snapshot
+
+# thread -> {product id -> ProductInventory row (with its product loaded)}; every thread has its own rows, so
+# their quantities only change under that thread's reservations, while an invalidation reaches all of them
+_caches = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def _cache():
+    thread = threading.current_thread()
+    with _lock:
+        return _caches.setdefault(thread, {})
+
+
+def get_inventory(product_id):
+    """Return this thread's cached ProductInventory row for product_id, loading it on first use"""
+
+    product_id = str(product_id)
+    inventory_product = _cache().get(product_id)
+    if inventory_product is None:
+        try:
+            inventory_product = ProductInventory.objects.select_related("product").get(product_id=product_id)
+        except ProductInventory.DoesNotExist:
+            # surface unknown products the same way Product.objects.get does
+            Product.objects.get(id=product_id)
+            raise
+        _cache()[product_id] = inventory_product
+    return inventory_product
+
+
+def get_inventories(product_ids):
+    """Return {product id: ProductInventory} for product_ids, loading every uncached row in one query"""
+
+    cache = _cache()
+    found = {}
+    missing = []
+    for product_id in {str(product_id) for product_id in product_ids}:
+        inventory_product = cache.get(product_id)
+        if inventory_product is None:
+            missing.append(product_id)
+        else:
+            found[product_id] = inventory_product
+    if missing:
+        # built from what was loaded, as an invalidation may empty the cache at any time
+        for inventory_product in ProductInventory.objects.select_related("product").filter(product_id__in=missing):
+            found[str(inventory_product.product_id)] = cache[str(inventory_product.product_id)] = inventory_product
+        for product_id in missing:
+            if product_id not in found:
+                found[product_id] = get_inventory(product_id)
+    return found
+
+
+def get_quantity(product_id):
+    return get_inventory(product_id).quantity
+
+
+def refresh_quantities(inventory_products):
+    """Re-read the quantities of inventory_products from the table in one query"""
+
+    inventory_products = list(inventory_products)
+    quantities = dict(
+        ProductInventory.objects.filter(id__in=[row.id for row in inventory_products]).values_list("id", "quantity")
+    )
+    for inventory_product in inventory_products:
+        inventory_product.quantity = quantities[inventory_product.id]
+        _cache()[str(inventory_product.product_id)] = inventory_product
+
+
+@retry_on_locked
+def reserve(inventory_product, quantity):
+    """Atomically take quantity from stock if at least that much is left, returning whether it was taken
+
+    The check and the reserve movement are one INSERT ... SELECT, and SQLite runs one writer at a time, so
+    concurrent workers can never oversell. Only the ledger is written, never the ProductInventory row.
+    """
+
+    movement_table = InventoryMovement._meta.db_table
+    inventory_table = ProductInventory._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {movement_table} (product_id, kind, quantity, delta, created_at) "
+            f"SELECT inventory.product_id, %s, %s, %s, %s FROM {inventory_table} inventory "
+            f"WHERE inventory.id = %s AND inventory.snapshot_quantity + COALESCE(("
+            f"SELECT SUM(movement.delta) FROM {movement_table} movement "
+            f"WHERE movement.product_id = inventory.product_id AND movement.id > inventory.last_movement_id"
+            f"), 0) >= %s",
+            [InventoryMovement.RESERVE, quantity, -quantity,
+             connection.ops.adapt_datetimefield_value(timezone.now()), inventory_product.id, quantity]
+        )
+        reserved = cursor.rowcount
+    if reserved:
+        inventory_product.quantity -= quantity
+    return bool(reserved)
+
+
+def reserve_up_to(inventory_product, quantity):
+    """Atomically take as much of quantity as is in stock, returning the amount taken"""
+
+    if inventory_product.quantity < quantity:
+        # another worker may have restocked since this row was cached
+        refresh_quantities([inventory_product])
+
+    while True:
+        available = min(quantity, inventory_product.quantity)
+        if available <= 0:
+            return 0
+        if reserve(inventory_product, available):
+            return available
+        # the cached quantity was stale, another worker took stock first
+        refresh_quantities([inventory_product])
+
+
+def adjust_quantity(inventory_product, delta):
+    """Add delta (negative for decrements) to the inventory quantity by recording a movement in the ledger"""
+    adjust_quantities([(inventory_product, delta)])
+
+
+@retry_on_locked
+def adjust_quantities(adjustments):
+    """Add (ProductInventory, delta) adjustments to stock with one bulk insert of their movements"""
+
+    adjustments = [(inventory_product, delta) for inventory_product, delta in adjustments if delta]
+    InventoryMovement.objects.bulk_create([
+        InventoryMovement(
+            product_id=inventory_product.product_id,
+            kind=InventoryMovement.RESTOCK if delta > 0 else InventoryMovement.ADJUST,
+            quantity=abs(delta),
+            delta=delta
+        )
+        for inventory_product, delta in adjustments
+    ])
+    for inventory_product, delta in adjustments:
+        inventory_product.quantity += delta
+        _cache()[str(inventory_product.product_id)] = inventory_product
+
+
+@retry_on_locked
+def take_snapshots(product_ids=None):
+    """Fold the movements recorded since the last snapshot into ProductInventory, returning how many products moved
+
+    Every product that moved also gets an InventorySnapshot row, which stock_at starts from. Current stock
+    stays the same, only the number of movements it is derived from drops.
+    """
+
+    with transaction.atomic():
+        last_movement_id = InventoryMovement.objects.aggregate(last=Max("id"))["last"]
+        if last_movement_id is None:
+            return 0
+
+        rows = ProductInventory.stored.filter(last_movement_id__lt=last_movement_id)
+        if product_ids is not None:
+            rows = rows.filter(product_id__in=[str(product_id) for product_id in product_ids])
+
+        moved = InventoryMovement.objects.filter(
+            product_id=OuterRef("product_id"), id__gt=OuterRef("last_movement_id"), id__lte=last_movement_id
+        )
+        folded = list(
+            rows.filter(Exists(moved))
+            .annotate(folded=F("snapshot_quantity") + movements_since_snapshot(last_movement_id))
+            .values_list("product_id", "folded")
+        )
+        rows.update(
+            snapshot_quantity=F("snapshot_quantity") + movements_since_snapshot(last_movement_id),
+            last_movement_id=last_movement_id
+        )
+        InventorySnapshot.objects.bulk_create([
+            InventorySnapshot(product_id=product_id, quantity=quantity, last_movement_id=last_movement_id)
+            for product_id, quantity in folded
+        ])
+
+    return len(folded)
+
+
+def snapshot_if_due():
+    """Take snapshots once NEST_INVENTORY_SNAPSHOT_INTERVAL movements were recorded since the oldest one"""
+
+    interval = getattr(settings, "NEST_INVENTORY_SNAPSHOT_INTERVAL", 1000)
+    if not interval:
+        return 0
+    # one query: movements after the snapshot every product has caught up to
+    oldest = ProductInventory.stored.order_by("last_movement_id").values("last_movement_id")[:1]
+    if InventoryMovement.objects.filter(id__gt=Subquery(oldest)).count() < interval:
+        return 0
+    return take_snapshots()
+
+
+def stock_at(product_id, when):
+    """Stock of product_id at the datetime when, from the last snapshot before it and the movements after that"""
+
+    product_id = str(product_id)
+    snapshot = InventorySnapshot.objects.filter(product_id=product_id, created_at__lte=when) \
+        .order_by("-created_at", "-id").first()
+    quantity, after = (snapshot.quantity, snapshot.last_movement_id) if snapshot else (0, 0)
+    moved = InventoryMovement.objects.filter(product_id=product_id, id__gt=after, created_at__lte=when) \
+        .aggregate(total=Sum("delta"))["total"]
+    return quantity + (moved or 0)
+
+
+def invalidate(product_id=None):
+    """Drop one product, or everything when product_id is None, from the cache of every thread"""
+
+    with _lock:
+        caches = list(_caches.values())
+    for cache in caches:
+        if product_id is None:
+            cache.clear()
+        else:
+            cache.pop(str(product_id), None)
+
+
+@receiver(post_save, sender=ProductInventory)
+@receiver(post_delete, sender=ProductInventory)
+def invalidate_inventory(sender, instance, **kwargs):
+    invalidate(instance.product_id)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product(sender, instance, **kwargs):
+    invalidate(instance.id)
@@ -0,0 +1,92 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from nest_app import shipment_log
+from nest_app.benchmark import MASS_DISTRIBUTIONS, compare, load_baseline, run_scale, save_baseline
+
+
+class Command(BaseCommand):
+    help = 'Benchmark order, restock and shipping throughput on synthetic load in a scratch database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', default='1000',
+                            help='Comma separated order counts to run, e.g. 1000,10000,100000,1000000')
+        parser.add_argument('--catalog', default='./test_inventory.json',
+                            help='Catalog the synthetic products are modelled on')
+        parser.add_argument('--skus', type=int, default=13)
+        parser.add_argument('--skew', type=float, default=1.0,
+                            help='Zipf exponent of product popularity, 0 for uniform')
+        parser.add_argument('--mass-distribution', choices=MASS_DISTRIBUTIONS, default='catalog')
+        parser.add_argument('--max-lines', type=int, default=3, help='Most products per order')
+        parser.add_argument('--max-quantity', type=int, default=4, help='Most units per ordered product')
+        parser.add_argument('--restock-every', type=int, default=100, help='Orders between restocks')
+        parser.add_argument('--restock-quantity', type=int, default=None)
+        parser.add_argument('--batch-size', type=int, default=1,
+                            help='Orders per process_orders call, 1 drives process_order')
+        parser.add_argument('--ship-packages', type=int, default=100,
+                            help='Direct ship_package calls measured after the orders')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the report as a JSON baseline to this path')
+        parser.add_argument('--compare', help='Baseline JSON to compare the report against')
+        parser.add_argument('--tolerance', type=float, default=0.1,
+                            help='Relative change counted as a regression when comparing')
+
+    def handle(self, *args, **kwargs):
+        try:
+            scales = [int(scale) for scale in kwargs['scales'].split(',')]
+        except ValueError:
+            raise CommandError('--scales must be comma separated integers.')
+        if any(scale < 1 for scale in scales):
+            raise CommandError('Every scale must be at least 1 order.')
+
+        with open(kwargs['catalog']) as f:
+            base_catalog = json.load(f)
+
+        config = {
+            'skus': kwargs['skus'],
+            'skew': kwargs['skew'],
+            'mass_distribution': kwargs['mass_distribution'],
+            'max_lines': kwargs['max_lines'],
+            'max_quantity': kwargs['max_quantity'],
+            'restock_every': kwargs['restock_every'],
+            'restock_quantity': kwargs['restock_quantity'],
+            'batch_size': kwargs['batch_size'],
+            'ship_packages': kwargs['ship_packages'],
+            'seed': kwargs['seed'],
+        }
+        report = {'config': config, 'results': {}}
+
+        # scratch database so the benchmark never touches real orders; shipment records are discarded
+        old_config = setup_databases(verbosity=0, interactive=False)
+        shipment_log.close()
+        try:
+            with override_settings(NEST_SHIPMENT_LOG={'path': '/dev/null'}):
+                for scale in scales:
+                    result = run_scale(scale, base_catalog, **config)
+                    report['results'][str(scale)] = result
+                    self.write_result(scale, result)
+                shipment_log.close()
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        if kwargs['output']:
+            save_baseline(report, kwargs['output'])
+            self.stdout.write(f'Baseline written to {kwargs["output"]}')
+
+        if kwargs['compare']:
+            regressions = compare(report, load_baseline(kwargs['compare']), kwargs['tolerance'])
+            for scale, metric, old, new, change in regressions:
+                self.stdout.write(self.style.WARNING(f'{scale} orders {metric}: {old} -> {new} ({change:+}%)'))
+            if regressions:
+                raise CommandError(f'{len(regressions)} metrics regressed against {kwargs["compare"]}.')
+            self.stdout.write(self.style.SUCCESS(f'No regressions against {kwargs["compare"]}.'))
+
+    def write_result(self, scale, result):
+        self.stdout.write(f'{scale} orders in {result["elapsed_s"]}s: {result["orders_per_sec"]} orders/s, '
+                          f'{result["queries_per_order"]} queries/order, {result["shipments"]} shipments')
+        for operation, stats in result['operations'].items():
+            if stats:
+                self.stdout.write(f'  {operation}: {stats["per_sec"]}/s, {stats["queries_per_call"]} queries/call, '
+                                  f'p50 {stats["p50_ms"]}ms p95 {stats["p95_ms"]}ms p99 {stats["p99_ms"]}ms')
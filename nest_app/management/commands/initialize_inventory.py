@@ -1,17 +1,22 @@
-import json
-
 from django.core.management.base import BaseCommand, CommandError
 
-from nest_app.processing import init_catalog
-
-product_info = json.loads(open('./test_inventory.json').read())
+from nest_app.catalog import CATALOG_CHUNK_SIZE, iter_catalog, load_catalog
 
 
 class Command(BaseCommand):
-    help = 'Initialize Product Inventory on startup'
+    help = 'Load or update the product catalog, creating empty inventory for new products'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='./test_inventory.json',
+                            help='Catalog file, a JSON array of products or one product per line')
+        parser.add_argument('--chunk-size', type=int, default=CATALOG_CHUNK_SIZE,
+                            help='Products written per transaction')
 
     def handle(self, *args, **kwargs):
         try:
-            init_catalog(product_info)
+            counts = load_catalog(iter_catalog(kwargs['path']), kwargs['chunk_size'])
         except Exception as e:
-            raise CommandError('Initialization failed.')
+            raise CommandError(f'Initialization failed: {e}')
+
+        self.stdout.write(f'{counts["created"]} products created, {counts["updated"]} updated, '
+                          f'{counts["unchanged"]} unchanged.')
@@ -0,0 +1,34 @@
+import multiprocessing
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from nest_app.fulfillment import run_worker
+
+
+class Command(BaseCommand):
+    help = 'Drain the fulfillment outbox, allocating stock and shipping queued orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=getattr(settings, 'NEST_FULFILLMENT_WORKERS', 1),
+                            help='Worker processes draining the outbox in parallel')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Tasks a worker claims at a time')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait when the outbox is empty')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit when the outbox is empty instead of polling')
+
+    def handle(self, *args, **kwargs):
+        worker_args = (kwargs['batch_size'], kwargs['poll_interval'], kwargs['once'])
+
+        if kwargs['processes'] <= 1:
+            total = run_worker(*worker_args)
+        else:
+            # forked workers must open their own database connections
+            connections.close_all()
+            with multiprocessing.Pool(kwargs['processes']) as pool:
+                total = sum(pool.starmap(run_worker, [worker_args] * kwargs['processes']))
+
+        self.stdout.write(f'Fulfilled {total} orders.')
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from nest_app.inventory import take_snapshots
+
+
+class Command(BaseCommand):
+    help = 'Fold the inventory movements recorded since the last snapshot into new snapshots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_ids', nargs='*',
+                            help='Products to snapshot, every product when none are given')
+
+    def handle(self, *args, **kwargs):
+        snapshotted = take_snapshots(kwargs['product_ids'] or None)
+
+        self.stdout.write(f'Snapshotted {snapshotted} products.')
@@ -0,0 +1,151 @@
+import functools
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+# upper bounds of the histogram buckets, Prometheus style (a final +Inf bucket is implied)
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+HISTOGRAMS = {
+    "nest_operation_duration_seconds": ("Wall time per call", DURATION_BUCKETS),
+    "nest_operation_db_seconds": ("Time spent in database queries per call", DURATION_BUCKETS),
+    "nest_operation_queries": ("SQL queries per call", COUNT_BUCKETS),
+    "nest_operation_shipments": ("Shipments created per call", COUNT_BUCKETS),
+}
+ERRORS_TOTAL = "nest_operation_errors_total"
+
+_local = threading.local()
+
+
+def enabled():
+    return getattr(settings, "NEST_METRICS_ENABLED", False)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """In-process histograms and counters keyed by metric name and operation"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {name: {} for name in HISTOGRAMS}
+        self.errors = {}
+
+    def observe(self, name, operation, value):
+        with self._lock:
+            histogram = self.histograms[name].get(operation)
+            if histogram is None:
+                histogram = self.histograms[name][operation] = Histogram(HISTOGRAMS[name][1])
+            histogram.observe(value)
+
+    def count_error(self, operation):
+        with self._lock:
+            self.errors[operation] = self.errors.get(operation, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {name: {} for name in HISTOGRAMS}
+            self.errors = {}
+
+    def render(self):
+        """Prometheus text exposition format"""
+
+        lines = []
+        with self._lock:
+            for name, (help_text, _) in HISTOGRAMS.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                for operation, histogram in sorted(self.histograms[name].items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{operation="{operation}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_bucket{{operation="{operation}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{operation="{operation}"}} {histogram.sum}')
+                    lines.append(f'{name}_count{{operation="{operation}"}} {histogram.count}')
+            lines.append(f"# HELP {ERRORS_TOTAL} Calls that raised an exception")
+            lines.append(f"# TYPE {ERRORS_TOTAL} counter")
+            for operation, count in sorted(self.errors.items()):
+                lines.append(f'{ERRORS_TOTAL}{{operation="{operation}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class Measurement:
+    """Query count, query time and shipments of one instrumented call, fed by connection.execute_wrapper"""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.shipments = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - start
+            self.queries += 1
+
+
+def shipment_created():
+    """Count a shipment against every instrumented call running on this thread"""
+    for measurement in getattr(_local, "active", ()):
+        measurement.shipments += 1
+
+
+def instrument(operation):
+    """Record wall time, query count, query time and shipments created for every call of the decorated function
+
+    When NEST_METRICS_ENABLED is off the only cost is one settings lookup per call.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+
+            measurement = Measurement()
+            active = getattr(_local, "active", None)
+            if active is None:
+                active = _local.active = []
+            active.append(measurement)
+            start = time.perf_counter()
+            try:
+                with connection.execute_wrapper(measurement):
+                    return func(*args, **kwargs)
+            except Exception:
+                registry.count_error(operation)
+                raise
+            finally:
+                active.remove(measurement)
+                registry.observe("nest_operation_duration_seconds", operation, time.perf_counter() - start)
+                registry.observe("nest_operation_db_seconds", operation, measurement.db_seconds)
+                registry.observe("nest_operation_queries", operation, measurement.queries)
+                registry.observe("nest_operation_shipments", operation, measurement.shipments)
+
+        return wrapper
+
+    return decorator
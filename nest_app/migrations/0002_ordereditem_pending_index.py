@@ -0,0 +1,31 @@
+# Generated by Django 3.2 on 2026-10-18 08:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.expressions
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nest_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ordereditem',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='shipment',
+            name='order',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, related_name='shipments', to='nest_app.order'),
+        ),
+        migrations.AddIndex(
+            model_name='ordereditem',
+            index=models.Index(condition=models.Q(quantity__gt=django.db.models.expressions.F('shipped_quantity')), fields=['product', 'created_at', 'id'], name='ordereditem_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.2 on 2026-10-18 08:42
+
+from django.db import migrations, models
+import nest_app.ids
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nest_app', '0002_ordereditem_pending_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ordereditem',
+            name='id',
+            field=models.CharField(default=nest_app.ids.new_id, max_length=50, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='productinventory',
+            name='id',
+            field=models.CharField(default=nest_app.ids.new_id, max_length=50, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='shipment',
+            name='id',
+            field=models.CharField(default=nest_app.ids.new_id, max_length=50, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='shippeditem',
+            name='id',
+            field=models.CharField(default=nest_app.ids.new_id, max_length=50, primary_key=True, serialize=False),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2 on 2026-10-18 08:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+import nest_app.ids
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nest_app', '0003_time_ordered_ids'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FulfillmentTask',
+            fields=[
+                ('id', models.CharField(default=nest_app.ids.new_id, max_length=50, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, related_name='fulfillment_tasks', to='nest_app.order')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='fulfillmenttask',
+            index=models.Index(fields=['status', 'id'], name='fulfillmenttask_status_idx'),
+        ),
+    ]
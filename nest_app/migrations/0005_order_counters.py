@@ -0,0 +1,53 @@
+# Generated by Django 3.2 on 2026-10-18 08:52
+
+from django.db import migrations, models
+
+
+def backfill_order_counters(apps, schema_editor):
+    Order = apps.get_model('nest_app', 'Order')
+    OrderedItem = apps.get_model('nest_app', 'OrderedItem')
+
+    counters = {}
+    for item in OrderedItem.objects.select_related('product').iterator():
+        order_counters = counters.setdefault(item.order_id, {'items_pending': 0, 'total_mass_g': 0, 'shipped_mass_g': 0})
+        order_counters['items_pending'] += 1 if item.quantity > item.shipped_quantity else 0
+        order_counters['total_mass_g'] += item.product.mass_g * item.quantity
+        order_counters['shipped_mass_g'] += item.product.mass_g * item.shipped_quantity
+
+    for order in Order.objects.iterator():
+        order_counters = counters.get(order.id, {'items_pending': 0, 'total_mass_g': 0, 'shipped_mass_g': 0})
+        Order.objects.filter(id=order.id).update(
+            status='pending' if order_counters['items_pending'] else 'completed',
+            **order_counters
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nest_app', '0004_fulfillment_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='items_pending',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='shipped_mass_g',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('completed', 'Completed')], db_index=True, default='pending', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_mass_g',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_order_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 3.2 on 2026-10-18 09:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def snapshot_existing_stock(apps, schema_editor):
+    ProductInventory = apps.get_model('nest_app', 'ProductInventory')
+    InventorySnapshot = apps.get_model('nest_app', 'InventorySnapshot')
+
+    InventorySnapshot.objects.bulk_create([
+        InventorySnapshot(product_id=product_id, quantity=quantity, last_movement_id=0)
+        for product_id, quantity in ProductInventory.objects.values_list('product_id', 'snapshot_quantity').iterator()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nest_app', '0006_idempotency_records'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='productinventory',
+            old_name='quantity',
+            new_name='snapshot_quantity',
+        ),
+        migrations.AddField(
+            model_name='productinventory',
+            name='last_movement_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='InventorySnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField()),
+                ('last_movement_id', models.BigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, related_name='snapshots', to='nest_app.product')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='InventoryMovement',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('restock', 'Restock'), ('reserve', 'Reserve'), ('ship', 'Ship'), ('adjust', 'Adjust')], max_length=20)),
+                ('quantity', models.IntegerField()),
+                ('delta', models.IntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, related_name='movements', to='nest_app.product')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='inventorysnapshot',
+            index=models.Index(fields=['product', 'created_at'], name='snapshot_product_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='inventorymovement',
+            index=models.Index(fields=['product', 'id'], name='movement_product_idx'),
+        ),
+        migrations.RunPython(snapshot_existing_stock, migrations.RunPython.noop),
+    ]
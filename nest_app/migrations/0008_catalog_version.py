@@ -0,0 +1,25 @@
+# Generated by Django 3.2 on 2026-10-18 09:20
+
+from django.db import migrations, models
+
+
+def create_catalog_version(apps, schema_editor):
+    apps.get_model('nest_app', 'CatalogVersion').objects.create(id=1, version=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nest_app', '0007_inventory_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_catalog_version, migrations.RunPython.noop),
+    ]
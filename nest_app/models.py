@@ -1,9 +1,16 @@
-import random
+from django.db import models, transaction
+from django.db.models import Case, F, OuterRef, Prefetch, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
 
-from django.db import models
+from nest_app import metrics, products, shipment_log
+from nest_app.ids import new_id
+from nest_app.packing import plan_packages
 
 MAX_SHIPMENT_MASS = 1800
 
+# ordered items whose shipped quantity is written per UPDATE
+SHIPPED_ITEMS_BATCH_SIZE = 500
+
 
 class Product(models.Model):
     id = models.CharField(max_length=50, primary_key=True)
@@ -11,14 +18,116 @@ class Product(models.Model):
     mass_g = models.IntegerField(default=0)
 
 
+class CatalogVersion(models.Model):
+    """Single row counting catalog changes, so every process can tell when its cached catalog is stale"""
+
+    version = models.BigIntegerField(default=0)
+
+    @classmethod
+    def current(cls):
+        return cls.objects.filter(id=1).values_list("version", flat=True).first() or 0
+
+    @classmethod
+    def bump(cls):
+        if not cls.objects.filter(id=1).update(version=F("version") + 1):
+            cls.objects.create(id=1, version=1)
+
+
+class InventoryMovement(models.Model):
+    """One change to a product's stock; rows are only ever inserted"""
+
+    RESTOCK = "restock"
+    RESERVE = "reserve"
+    SHIP = "ship"
+    ADJUST = "adjust"
+    KIND_CHOICES = [(RESTOCK, "Restock"), (RESERVE, "Reserve"), (SHIP, "Ship"), (ADJUST, "Adjust")]
+
+    # autoincrementing, so movements are numbered in the order they were committed
+    id = models.BigAutoField(primary_key=True)
+    product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, related_name="movements")
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    quantity = models.IntegerField()
+    # signed change to stock: reserving takes the stock, so shipping what was reserved changes nothing
+    delta = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["product", "id"], name="movement_product_idx"),
+        ]
+
+
+class InventorySnapshot(models.Model):
+    """Stock of a product once every movement up to last_movement_id was applied"""
+
+    product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, related_name="snapshots")
+    quantity = models.IntegerField()
+    last_movement_id = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["product", "created_at"], name="snapshot_product_idx"),
+        ]
+
+
+def movements_since_snapshot(up_to=None):
+    """Sum of the deltas of the outer ProductInventory's product moved since its snapshot, as a subquery"""
+
+    movements = InventoryMovement.objects.filter(product_id=OuterRef("product_id"), id__gt=OuterRef("last_movement_id"))
+    if up_to is not None:
+        movements = movements.filter(id__lte=up_to)
+    total = movements.order_by().values("product_id").annotate(total=Sum("delta")).values("total")
+    return Coalesce(Subquery(total), 0)
+
+
+class ProductInventoryManager(models.Manager):
+    def get_queryset(self):
+        # current stock is the latest snapshot plus what moved since, so only the ledger is written per change
+        return super().get_queryset().annotate(quantity=F("snapshot_quantity") + movements_since_snapshot())
+
+
 class ProductInventory(models.Model):
-    id = models.CharField(max_length=50, primary_key=True)
+    """Stock of a product, derived from its last snapshot and the movements recorded after it"""
+
+    id = models.CharField(max_length=50, primary_key=True, default=new_id)
     product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, null=False)
-    quantity = models.IntegerField(default=0)
+    snapshot_quantity = models.IntegerField(default=0)
+    last_movement_id = models.BigIntegerField(default=0)
+
+    objects = ProductInventoryManager()
+    # the stored columns only, for writes and aggregates that need no current stock
+    stored = models.Manager()
+
+
+class OrderQuerySet(models.QuerySet):
+    def pending(self):
+        """Orders with items still waiting on stock"""
+        return self.filter(status=Order.PENDING)
+
+    def with_details(self):
+        """Prefetch items, shipments and shipped items with their products: four queries for any number of orders"""
+        return self.prefetch_related(
+            Prefetch("ordereditem_set", queryset=OrderedItem.objects.select_related("product").order_by("created_at", "id")),
+            Prefetch("shipments", queryset=Shipment.objects.order_by("id").prefetch_related(
+                Prefetch("shippeditem_set", queryset=ShippedItem.objects.select_related("product").order_by("id"))
+            ))
+        )
 
 
 class Order(models.Model):
+    PENDING = "pending"
+    COMPLETED = "completed"
+    STATUS_CHOICES = [(PENDING, "Pending"), (COMPLETED, "Completed")]
+
     id = models.CharField(max_length=50, primary_key=True)
+    # maintained incrementally as items are created and shipped, so reading them never touches the items
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    items_pending = models.IntegerField(default=0)
+    total_mass_g = models.IntegerField(default=0)
+    shipped_mass_g = models.IntegerField(default=0)
+
+    objects = OrderQuerySet.as_manager()
 
     @property
     def items(self):
@@ -26,91 +135,114 @@ class Order(models.Model):
 
     @property
     def completed(self):
-        for item in self.items:
-            if not item.shipped:
-                return False
-        return True
+        return self.status == Order.COMPLETED
 
     @property
     def total_mass(self):
-        masses = [item.total_mass for item in self.items]
-        return sum(masses, 0)
+        return self.total_mass_g
+
+    def set_counters(self, ordered_items):
+        """Set the counters of an order that is not saved yet from its in-memory ordered items"""
+        self.items_pending = sum(1 for item in ordered_items if not item.shipped)
+        self.total_mass_g = sum(products.mass_g(item.product_id) * item.quantity for item in ordered_items)
+        self.shipped_mass_g = sum(products.mass_g(item.product_id) * item.shipped_quantity for item in ordered_items)
+        self.status = Order.PENDING if self.items_pending else Order.COMPLETED
+
+    def record_items(self, items_pending=0, total_mass_g=0, shipped_mass_g=0):
+        """Add to the counters of a saved order in one UPDATE, recomputing its status"""
+
+        if not (items_pending or total_mass_g or shipped_mass_g):
+            return
+        Order.objects.filter(id=self.id).update(
+            items_pending=F("items_pending") + items_pending,
+            total_mass_g=F("total_mass_g") + total_mass_g,
+            shipped_mass_g=F("shipped_mass_g") + shipped_mass_g,
+            # the CASE sees the values from before the update
+            status=Case(
+                When(items_pending__gt=-items_pending, then=Value(Order.PENDING)),
+                default=Value(Order.COMPLETED)
+            )
+        )
+        self.items_pending += items_pending
+        self.total_mass_g += total_mass_g
+        self.shipped_mass_g += shipped_mass_g
+        self.status = Order.PENDING if self.items_pending > 0 else Order.COMPLETED
 
-    def ship(self):
-        if self.total_mass <= MAX_SHIPMENT_MASS:
-            shipped = []
-            for item in self.items:
-                shipped_item = {"product_id": item.product.id, "quantity": item.quantity_needed}
-                item.update_quantity(item.quantity_needed)
-                shipped.append(shipped_item)
+    def ship(self, allocations=None):
+        """Ship (ordered_item, quantity) allocations, or every pending item, packed into as few packages as possible"""
+        if allocations is None:
+            allocations = [(item, item.quantity_needed) for item in self.items.pending()]
+        ship_items(self, allocations)
 
-            shipment = {"order_id": self.id, "shipped": shipped}
-            ship_package(shipment)
-        else:
-            raise Exception
+
+class OrderedItemQuerySet(models.QuerySet):
+    def pending(self):
+        """Items still waiting on stock, oldest first"""
+        return self.filter(quantity__gt=F("shipped_quantity")).order_by("created_at", "id")
 
 
 class OrderedItem(models.Model):
-    id = models.CharField(max_length=50, primary_key=True)
+    id = models.CharField(max_length=50, primary_key=True, default=new_id)
     product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, null=False)
     order = models.ForeignKey(Order, on_delete=models.DO_NOTHING, null=False)
     quantity = models.IntegerField(default=1)
     shipped_quantity = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = OrderedItemQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["product", "created_at", "id"],
+                condition=Q(quantity__gt=F("shipped_quantity")),
+                name="ordereditem_pending_idx"
+            ),
+        ]
 
     @property
     def total_mass(self):
-        if self.quantity == 1:
-            return self.product.mass_g
-        else:
-            return self.product.mass_g * self.quantity
+        return products.mass_g(self.product_id) * self.quantity
 
     @property
     def shipped(self):
         return self.quantity == self.shipped_quantity
 
     def ship(self, quantity):
-        if (self.product.mass_g * quantity) < MAX_SHIPMENT_MASS:
-            self.update_quantity(quantity)
-            shipment = {"order_id": self.order.id,
-                        "shipped": [
-                            {"product_id": self.product.id, "quantity": quantity}
-                        ]}
-            ship_package(shipment)
-        else:
-            shipment_mass = 0
-            quantity_in_shipment = 0
-
-            for q in range(0, quantity):
-                if (shipment_mass + self.product.mass_g) < MAX_SHIPMENT_MASS:
-                    shipment_mass += self.product.mass_g
-                    quantity_in_shipment += 1
-                else:
-                    break
-
-            if quantity_in_shipment > 0:
-                self.update_quantity(quantity_in_shipment)
-                shipped_item = {"product_id": self.product.id, "quantity": quantity_in_shipment}
-                shipment = {"order_id": self.order.id, "shipped": [shipped_item]}
-                ship_package(shipment)
-                remaining_to_ship = quantity - quantity_in_shipment
-                if remaining_to_ship != 0:
-                    self.ship(remaining_to_ship)
-
-            else:
-                print("Item is too heavy to ship")
-                raise Exception
+        ship_items(self.order, [(self, quantity)])
 
     @property
     def quantity_needed(self):
         return self.quantity - self.shipped_quantity
 
     def update_quantity(self, quantity_shipped):
+        """Record quantity_shipped more of the item as shipped, without writing a shipment, keeping the order's
+        counters in step"""
+
+        was_shipped = self.shipped
         self.shipped_quantity += quantity_shipped
-        self.save()
+        with transaction.atomic():
+            self.save(update_fields=["shipped_quantity"])
+            self.order.record_items(
+                items_pending=int(was_shipped) - int(self.shipped),
+                shipped_mass_g=products.mass_g(self.product_id) * quantity_shipped
+            )
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding:
+            # items created one at a time count towards their order here; bulk creates set the counters up front
+            mass_g = products.mass_g(self.product_id)
+            self.order.record_items(
+                items_pending=0 if self.shipped else 1,
+                total_mass_g=mass_g * self.quantity,
+                shipped_mass_g=mass_g * self.shipped_quantity
+            )
 
 
 class Shipment(models.Model):
-    id = models.CharField(max_length=50, primary_key=True)
+    id = models.CharField(max_length=50, primary_key=True, default=new_id)
     order = models.ForeignKey(Order, on_delete=models.DO_NOTHING, related_name="shipments")
 
     @property
@@ -119,11 +251,12 @@ class Shipment(models.Model):
 
     @property
     def total_mass(self):
-        return sum([item.total_mass for item in self.items], 0)
+        return sum(products.mass_g(product_id) * quantity
+                   for product_id, quantity in self.items.values_list("product_id", "quantity"))
 
 
 class ShippedItem(models.Model):
-    id = models.CharField(max_length=50, primary_key=True)
+    id = models.CharField(max_length=50, primary_key=True, default=new_id)
     product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, null=False)
     order = models.ForeignKey(Order, on_delete=models.DO_NOTHING, null=False)
     shipment = models.ForeignKey(Shipment, on_delete=models.DO_NOTHING, null=False)
@@ -131,43 +264,138 @@ class ShippedItem(models.Model):
 
     @property
     def total_mass(self):
-        if self.quantity == 1:
-            return self.product.mass_g
-        else:
-            return self.product.mass_g * self.quantity
+        return products.mass_g(self.product_id) * self.quantity
+
+
+class FulfillmentTask(models.Model):
+    """Outbox record written with an order, telling the fulfillment worker to allocate and ship it"""
+
+    PENDING = "pending"
+    PROCESSING = "processing"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [(PENDING, "Pending"), (PROCESSING, "Processing"), (DONE, "Done"), (FAILED, "Failed")]
+
+    id = models.CharField(max_length=50, primary_key=True, default=new_id)
+    order = models.ForeignKey(Order, on_delete=models.DO_NOTHING, related_name="fulfillment_tasks")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "id"], name="fulfillmenttask_status_idx"),
+        ]
+
+
+class IdempotencyRecord(models.Model):
+    """Result of an order request, replayed when a request with the same key comes in again"""
+
+    key = models.CharField(max_length=255, primary_key=True)
+    # hash of the request body, so a key reused for a different request is caught
+    fingerprint = models.CharField(max_length=64)
+    order = models.ForeignKey(Order, on_delete=models.DO_NOTHING, related_name="idempotency_records")
+    status_code = models.IntegerField(default=201)
+    result = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+def ship_items(order, allocations):
+    """Plan packages for (ordered_item, quantity) allocations of one order in memory, then write the shipments"""
+    ship_orders([(order, allocations)])
+
 
+def ship_orders(order_allocations):
+    """Ship (order, allocations) pairs, each packed on its own, writing the shipped quantities in bulk
 
+    An order may appear in several pairs; its counters are still updated once.
+    """
+
+    shipped_items = []
+    counters = {}
+    plans = []
+    for order, allocations in order_allocations:
+        lines = [(item, products.mass_g(item.product_id), quantity) for item, quantity in allocations]
+        plans.append((order, plan_packages(lines, MAX_SHIPMENT_MASS)))
+
+        order_counters = counters.setdefault(order.id, [order, 0, 0])
+        for item, quantity in allocations:
+            if quantity > 0:
+                item.shipped_quantity += quantity
+                shipped_items.append(item)
+                order_counters[1] += 1 if item.shipped else 0
+                order_counters[2] += products.mass_g(item.product_id) * quantity
+
+    OrderedItem.objects.bulk_update(shipped_items, ["shipped_quantity"], batch_size=SHIPPED_ITEMS_BATCH_SIZE)
+    for order, items_completed, shipped_mass_g in counters.values():
+        order.record_items(items_pending=-items_completed, shipped_mass_g=shipped_mass_g)
+
+    for order, packages in plans:
+        ship_packages(order, packages)
+
+
+def ship_packages(order, packages):
+    """Write one shipment per package planned for the ordered items of order"""
+    for package in packages:
+        create_shipment(order, [(products.get(item.product_id), quantity) for item, quantity in package["items"]])
+
+
+@metrics.instrument("ship_package")
 def ship_package(shipment):
+    products.sync()
     order = Order.objects.get(id=shipment["order_id"])
-    shipment_obj = Shipment.objects.create(
-        id=(str(random.randint(100000, 999999))),
-        order=order
-    )
-
-    for shipped_item in shipment["shipped"]:
-        product = Product.objects.get(id=shipped_item["product_id"])
-        ShippedItem.objects.create(
-            id=(str(random.randint(100000, 999999))),
-            product=product,
-            order=order,
-            shipment=shipment_obj,
-            quantity=shipped_item["quantity"]
-        )
-    shipment_items = [(shipment_item.product.name, shipment_item.quantity) for shipment_item in shipment_obj.items]
+    shipped = [(products.get(shipped_item["product_id"]), shipped_item["quantity"])
+               for shipped_item in shipment["shipped"]]
+    return create_shipment(order, shipped)
 
-    if shipment_obj.total_mass < MAX_SHIPMENT_MASS:
-        output = log_shipment(shipment_obj, shipment_items)
-        print(output)
-    else:
-        raise Exception('Shipment could not be deployed. Shipment weight greater than max capacity.')
 
+def create_shipment(order, shipped):
+    """Write a shipment of (product, quantity) pairs for order, products being Product or ProductInfo instances
+
+    The mass is computed in memory and the shipped items and their ship movements are inserted in bulk, so a
+    shipment costs the same number of queries however many items it holds.
+    """
 
-def log_shipment(shipment_obj, shipment_items):
-    output = (f"\n=====================================\n"
-              f"Shipment deployed: \n"
-              f"ID - {shipment_obj.id}\n"
-              f"ORDER ID- {shipment_obj.order.id}\n"
-              f"ITEMS/QUANTITY: {shipment_items}\n"
-              f"SHIPMENT WEIGHT (g): {shipment_obj.total_mass}\n"
-              f"=====================================\n")
-    return output
+    total_mass = sum(product.mass_g * quantity for product, quantity in shipped)
+    if total_mass >= MAX_SHIPMENT_MASS:
+        raise Exception('Shipment could not be deployed. Shipment weight greater than max capacity.')
+
+    # a savepoint inside an order or restock unit of work, a transaction of its own otherwise
+    with transaction.atomic():
+        shipment_obj = Shipment.objects.create(
+            order=order
+        )
+        ShippedItem.objects.bulk_create([
+            ShippedItem(
+                product_id=product.id,
+                order=order,
+                shipment=shipment_obj,
+                quantity=quantity
+            )
+            for product, quantity in shipped
+        ])
+        # the stock was taken when it was reserved, the ledger only records it leaving
+        InventoryMovement.objects.bulk_create([
+            InventoryMovement(product_id=product.id, kind=InventoryMovement.SHIP, quantity=quantity, delta=0)
+            for product, quantity in shipped
+        ])
+
+    metrics.shipment_created()
+
+    # only shipments that were committed are reported
+    record = shipment_log.shipment_record(shipment_obj, shipped, total_mass)
+    transaction.on_commit(lambda: shipment_log.emit(record))
+    return shipment_obj
+
+
+def log_shipment(shipment_obj, shipment_items, total_mass=None):
+    if total_mass is None:
+        total_mass = shipment_obj.total_mass
+    return shipment_log.format_text({
+        "shipment_id": shipment_obj.id,
+        "order_id": shipment_obj.order.id,
+        "items": [{"product_name": name, "quantity": quantity} for name, quantity in shipment_items],
+        "mass_g": total_mass,
+    })
@@ -0,0 +1,38 @@
+class ItemTooHeavy(Exception):
+    """One unit of an item weighs as much as a whole shipment may"""
+
+
+def plan_packages(lines, max_mass):
+    """Pack (key, mass_g, quantity) lines into as few packages as possible using first-fit-decreasing.
+
+    Every package stays below max_mass, matching the check made in ship_package. Returns a list of packages,
+    each a dict holding the package mass and its (key, quantity) pairs in packing order.
+    """
+
+    packages = []
+
+    for key, mass_g, quantity in sorted(lines, key=lambda line: line[1], reverse=True):
+        if quantity <= 0:
+            continue
+        if mass_g >= max_mass:
+            raise ItemTooHeavy('Item is too heavy to ship')
+
+        remaining = quantity
+        # units of one line are identical, so first-fit over the open packages can place them in bulk
+        for package in packages:
+            fits = remaining if mass_g == 0 else (max_mass - 1 - package["mass_g"]) // mass_g
+            if fits <= 0:
+                continue
+            placed = min(fits, remaining)
+            package["mass_g"] += mass_g * placed
+            package["items"].append((key, placed))
+            remaining -= placed
+            if remaining == 0:
+                break
+
+        while remaining > 0:
+            placed = remaining if mass_g == 0 else min(remaining, (max_mass - 1) // mass_g)
+            packages.append({"mass_g": mass_g * placed, "items": [(key, placed)]})
+            remaining -= placed
+
+    return packages
@@ -0,0 +1,13 @@
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """Pages ordered by primary key, each page fetched with WHERE id > cursor so deep pages cost the same as the first
+
+    The primary key is unique, so the cursor never needs an offset to break ties.
+    """
+
+    ordering = "id"
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
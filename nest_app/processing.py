@@ -1,102 +1,302 @@
-import random
+from contextlib import contextmanager
 
-from nest_app.models import Product, ProductInventory, OrderedItem, Order
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from nest_app import allocation, idempotency, inventory, metrics, products
+from nest_app.catalog import load_catalog
+from nest_app.db import retry_on_locked
+from nest_app.models import OrderedItem, Order, FulfillmentTask, Product, ProductInventory, ship_packages
+from nest_app.packing import ItemTooHeavy, plan_packages
 
 MAX_SHIPMENT_MASS = 1800
 
+# errors caused by what a request asked for, which every endpoint reports as a bad request
+REQUEST_ERRORS = (Product.DoesNotExist, ProductInventory.DoesNotExist, ItemTooHeavy)
+
+
+def request_error_detail(error):
+    """Detail reported for one of the REQUEST_ERRORS, or None for any other error"""
+    if isinstance(error, ItemTooHeavy):
+        return "Item is too heavy to ship."
+    if isinstance(error, (Product.DoesNotExist, ProductInventory.DoesNotExist)):
+        return "Unknown product."
+    return None
+
+
+def fulfillment_deferred():
+    """True when order intake only records an outbox task and the fulfillment worker ships the order"""
+    return getattr(settings, "NEST_FULFILLMENT_MODE", "inline") == "outbox"
+
+
+@contextmanager
+def unit_of_work():
+    """Run the block as one transaction on the current catalog, dropping cached inventory if it rolls back"""
+
+    try:
+        with transaction.atomic():
+            # masses must match the catalog other processes may have changed
+            products.sync()
+            yield
+    except Exception:
+        # cached quantities may no longer match the rolled back table
+        inventory.invalidate()
+        raise
+
 
 def init_catalog(product_info):
-    """Initialize the Product and ProductInventory table using passed in product_info json"""
+    """Initialize the Product and ProductInventory table using passed in product_info json
+
+    Safe to run again: products already loaded are updated in place and keep their stock.
+    """
+    return load_catalog(product_info)
+
+
+@metrics.instrument("process_restock")
+@retry_on_locked
+def process_restock(restock, policy=None, consolidate=None):
+    """Restock products by adding the restocked quantities to ProductInventory, then ship pending items
+
+    All deltas are recorded with one bulk insert of restock movements, in one transaction. The pending
+    items of every restocked product are then loaded into arrays, the stock they can take is reserved with
+    one conditional update per product, and it is allocated in one vectorized pass by the allocation policy
+    (NEST_ALLOCATION_POLICY unless one is passed). Items freed for the same order are then packed together
+    unless consolidation is turned off. Inventory snapshots are taken afterwards once enough movements have
+    built up.
+    """
 
-    for product in product_info:
-        Product.objects.create(
-            id=product["product_id"],
-            name=product["product_name"],
-            mass_g=product["mass_g"]
+    deltas = {}
+    for restocked_product in restock:
+        product_id = str(restocked_product["product_id"])
+        deltas[product_id] = deltas.get(product_id, 0) + restocked_product["quantity"]
+
+    inventory_products = inventory.get_inventories(deltas)
+
+    with unit_of_work():
+        inventory.adjust_quantities(
+            (inventory_products[product_id], delta) for product_id, delta in deltas.items()
         )
+        # other workers may have moved stock since the rows were cached
+        inventory.refresh_quantities(inventory_products.values())
+
+        demand = allocation.PendingDemand.load(deltas)
+        available = {
+            product_id: inventory.reserve_up_to(inventory_products[product_id], needed)
+            for product_id, needed in demand.totals().items()
+        }
+        allocation.write_plan(allocation.allocate(demand, available, policy), consolidate)
+
+    inventory.snapshot_if_due()
+    return list(inventory_products.values())
+
+
+def process_order(order, idempotency_key=None):
+    """Process incoming order json, ship available items
+
+    The order is one unit of work: an unknown product or a failed shipment leaves nothing behind. With
+    NEST_FULFILLMENT_MODE = 'outbox' the order is committed with a FulfillmentTask instead of being shipped.
+    The result is recorded in the same unit of work under idempotency_key, the order id's key unless one is
+    passed, so an order sent again returns the order it created instead of being processed twice.
+    """
+
+    if idempotency_key is None:
+        idempotency_key = idempotency.request_key(order["order_id"])
+    if idempotency.replay(idempotency_key, order) is not None:
+        return Order.objects.get(id=order["order_id"])
+    order_obj, _ = _create_order(order, idempotency_key)
+    return order_obj
+
+
+def submit_order(order, client_key=None):
+    """Process order json once per request, returning the recorded Entry and whether it was replayed
+
+    The request is keyed by the client's Idempotency-Key, or the order id without one. A key or order id
+    already used by a different request raises IntegrityError.
+    """
 
-    for product in Product.objects.all():
-        ProductInventory.objects.create(
-            id=(str(random.randint(100000, 999999))),
-            product=product,
-            quantity=0
+    key = idempotency.request_key(order["order_id"], client_key)
+    entry = idempotency.replay(key, order)
+    if entry is not None:
+        return entry, True
+    try:
+        _, entry = _create_order(order, key)
+    except IntegrityError:
+        # the same request may have committed first on another worker
+        entry = idempotency.replay(key, order)
+        if entry is None:
+            raise
+        return entry, True
+    return entry, False
+
+
+@metrics.instrument("process_order")
+@retry_on_locked
+def _create_order(order, idempotency_key):
+    with unit_of_work():
+        order_obj = Order(
+            id=order["order_id"]
         )
 
+        ordered_items = []
 
-def process_restock(restock):
-    """Restock products by increasing quantity available in ProductInventory table"""
+        for item in order["requested"]:
+            inventory_product = inventory.get_inventory(item["product_id"])
+            ordered_items.append(OrderedItem(
+                product=inventory_product.product,
+                order=order_obj,
+                quantity=item["quantity"],
+                shipped_quantity=0
+            ))
 
-    for restocked_product in restock:
-        product = Product.objects.get(id=restocked_product["product_id"])
+        order_obj.set_counters(ordered_items)
+        order_obj.save(force_insert=True)
+        OrderedItem.objects.bulk_create(ordered_items)
 
-        inventory_product = ProductInventory.objects.get(product=product)
-        inventory_product.quantity = restocked_product["quantity"]
-        inventory_product.save()
+        if fulfillment_deferred():
+            FulfillmentTask.objects.create(order=order_obj)
+        else:
+            allocate_order(order_obj, ordered_items)
 
-        # checks for pending ordered items
-        order_items = OrderedItem.objects.filter(product=product)
-        pending_order_items = [item for item in order_items if not item.shipped]
+        entry, = idempotency.record([(idempotency_key, order, order_obj)])
 
-        for item in pending_order_items:
-            # sufficient inventory to fill order
-            if inventory_product.quantity >= item.quantity_needed:
-                fulfill_item_order(item, inventory_product)
-            # non zero inventory but not sufficient to complete order
-            elif inventory_product.quantity > 0:
-                partial_fulfill_item_order(item, inventory_product)
-            else:
-                break
+    return order_obj, entry
 
 
-def process_order(order):
-    """Process incoming order json, ship available items"""
+def plan_order(order):
+    """Work out how order json would ship right now, without writing anything
 
-    order_obj = Order.objects.create(
-        id=order["order_id"]
-    )
+    Products come from the catalog cache and stock is re-read for the requested products only, since other
+    processes take stock this one never hears about. Once the caches are warm a plan costs two queries: the
+    catalog version and the stock. Items get stock in the order they were requested, as in process_order,
+    and are packed with the same packer as Order.ship. Returns the packages and what would stay backordered.
+    """
 
-    not_available = []
+    products.sync()
+    inventory_products = inventory.get_inventories(item["product_id"] for item in order["requested"])
+    inventory.refresh_quantities(inventory_products.values())
+    stock = {product_id: max(inventory_product.quantity, 0) for product_id, inventory_product in inventory_products.items()}
 
+    lines = []
+    backordered = []
     for item in order["requested"]:
-        product = Product.objects.get(id=item["product_id"])
-        ordered_item = OrderedItem.objects.create(
-            id=str(random.randint(100000, 999999)),
-            product=product,
-            order=order_obj,
-            quantity=item["quantity"],
-            shipped_quantity=0
-        )
-        available_quantity = ProductInventory.objects.get(product=product).quantity
-        if ordered_item.quantity_needed > available_quantity:
-            not_available.append(ordered_item)
-
-    order_obj.save()
-
-    if not not_available and order_obj.total_mass <= MAX_SHIPMENT_MASS:
-        order_obj.ship()
-    else:
-        order_items = OrderedItem.objects.filter(order=order_obj)
-        pending_order_items = [item for item in order_items if not item.shipped]
-
-        for item in pending_order_items:
-            inventory_product = ProductInventory.objects.get(product=item.product)
-            # sufficient inventory to fill order
-            if inventory_product.quantity >= item.quantity_needed:
-                fulfill_item_order(item, inventory_product)
-            # non zero inventory but not sufficient to complete order
-            elif inventory_product.quantity > 0:
-                partial_fulfill_item_order(item, inventory_product)
-            else:
-                continue
-
-
-def fulfill_item_order(item, inventory_product):
-    item.ship(item.quantity_needed)
-    inventory_product.quantity -= item.quantity_needed
-    inventory_product.save()
-
-
-def partial_fulfill_item_order(item, inventory_product):
-    item.ship(inventory_product.quantity)
-    inventory_product.quantity = 0
-    inventory_product.save()
+        product_id = str(item["product_id"])
+        quantity = min(item["quantity"], stock[product_id])
+        stock[product_id] -= quantity
+        if quantity > 0:
+            lines.append((product_id, products.mass_g(product_id), quantity))
+        if quantity < item["quantity"]:
+            backordered.append({"product_id": product_id, "quantity": item["quantity"] - quantity})
+
+    packages = [
+        {
+            "mass_g": package["mass_g"],
+            "items": [
+                {"product_id": product_id, "product_name": products.get(product_id).name, "quantity": quantity}
+                for product_id, quantity in package["items"]
+            ],
+        }
+        for package in plan_packages(lines, MAX_SHIPMENT_MASS)
+    ]
+    return {"order_id": order["order_id"], "packages": packages, "backordered": backordered}
+
+
+def allocate_order(order_obj, ordered_items):
+    """Reserve available stock for the pending ordered items of one order and ship it packed together"""
+
+    # allocate available inventory to every item first so the whole order is packed together
+    allocations = []
+    for ordered_item in ordered_items:
+        inventory_product = inventory.get_inventory(ordered_item.product_id)
+        quantity = inventory.reserve_up_to(inventory_product, ordered_item.quantity_needed)
+        if quantity > 0:
+            allocations.append((ordered_item, quantity))
+
+    order_obj.ship(allocations)
+
+
+@metrics.instrument("process_orders")
+@retry_on_locked
+def process_orders(orders, idempotency_keys=None):
+    """Process a batch of incoming order json in one transaction, ship available items
+
+    Products and inventory for the whole batch are read in one query, stock for the batch is reserved with
+    one conditional update per product and allocated to the orders in the order they were passed in memory,
+    and the orders and ordered items are inserted in bulk before the shipments are written. Every result is
+    recorded in the same transaction under idempotency_keys, one per order and the order ids' keys unless
+    passed; orders already recorded are not processed again, the orders they created are returned instead.
+    """
+
+    if idempotency_keys is None:
+        idempotency_keys = [idempotency.request_key(order["order_id"]) for order in orders]
+    idempotency_keys = list(idempotency_keys)
+    replayed = idempotency.replay_many(idempotency_keys, orders)
+    if not replayed:
+        return _create_orders(orders, idempotency_keys)
+
+    new = [(order, key) for order, key in zip(orders, idempotency_keys) if key not in replayed]
+    created = iter(_create_orders([order for order, _ in new], [key for _, key in new]) if new else [])
+    existing = Order.objects.in_bulk([str(order["order_id"]) for order, key in zip(orders, idempotency_keys)
+                                      if key in replayed])
+    return [existing[str(order["order_id"])] if key in replayed else next(created)
+            for order, key in zip(orders, idempotency_keys)]
+
+
+def _create_orders(orders, idempotency_keys):
+    demand = {}
+    for order in orders:
+        for item in order["requested"]:
+            product_id = str(item["product_id"])
+            demand[product_id] = demand.get(product_id, 0) + item["quantity"]
+
+    inventory_products = inventory.get_inventories(demand)
+
+    with unit_of_work():
+        if fulfillment_deferred():
+            # nothing is allocated at intake, the fulfillment worker does it per order
+            available = {product_id: 0 for product_id in demand}
+        else:
+            available = {
+                product_id: inventory.reserve_up_to(inventory_products[product_id], quantity)
+                for product_id, quantity in demand.items()
+            }
+        order_objs = _write_orders(orders, inventory_products, available)
+        if fulfillment_deferred():
+            FulfillmentTask.objects.bulk_create([FulfillmentTask(order=order_obj) for order_obj in order_objs])
+        idempotency.record(zip(idempotency_keys, orders, order_objs))
+
+    return order_objs
+
+
+def _write_orders(orders, inventory_products, available):
+    order_objs = []
+    ordered_items = []
+    plans = []
+
+    for order in orders:
+        order_obj = Order(id=order["order_id"])
+        first_item = len(ordered_items)
+        lines = []
+        for item in order["requested"]:
+            product_id = str(item["product_id"])
+            product = inventory_products[product_id].product
+            quantity = min(item["quantity"], available[product_id])
+            available[product_id] -= quantity
+            ordered_item = OrderedItem(
+                product=product,
+                order=order_obj,
+                quantity=item["quantity"],
+                shipped_quantity=quantity
+            )
+            ordered_items.append(ordered_item)
+            lines.append((ordered_item, products.mass_g(product_id), quantity))
+        order_obj.set_counters(ordered_items[first_item:])
+        order_objs.append(order_obj)
+        plans.append((order_obj, plan_packages(lines, MAX_SHIPMENT_MASS)))
+
+    Order.objects.bulk_create(order_objs)
+    OrderedItem.objects.bulk_create(ordered_items)
+    for order_obj, packages in plans:
+        ship_packages(order_obj, packages)
+
+    return order_objs
+
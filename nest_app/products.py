@@ -0,0 +1,108 @@
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+
+ProductInfo = namedtuple("ProductInfo", ["id", "name", "mass_g"])
+
+# sent whenever products are created, changed or deleted, moving the catalog on to a new version
+catalog_changed = Signal()
+
+_version = 0
+_snapshot = None
+# CatalogVersion.version when this process last checked it
+_stored_version = None
+_lock = threading.Lock()
+
+
+def version():
+    return _version
+
+
+def snapshot():
+    """Immutable mapping of product id to ProductInfo for the current catalog version, loaded with one query
+
+    The mapping is never modified, so callers on any thread can keep reading one they already hold.
+    """
+
+    global _snapshot
+    current = _snapshot
+    if current is not None:
+        return current
+
+    from nest_app.models import Product
+
+    with _lock:
+        if _snapshot is not None:
+            return _snapshot
+        loaded_version = _version
+        current = MappingProxyType({
+            product_id: ProductInfo(product_id, name, mass_g)
+            for product_id, name, mass_g in Product.objects.values_list("id", "name", "mass_g")
+        })
+        # a change that landed while loading may be missing from the rows, so keep them for this call only
+        if loaded_version == _version:
+            _snapshot = current
+        return current
+
+
+def get(product_id):
+    """ProductInfo for product_id, raising Product.DoesNotExist for a product that is not in the catalog"""
+
+    product_id = str(product_id)
+    info = snapshot().get(product_id)
+    if info is None:
+        # the product may have been added by another process, which cannot signal this one
+        invalidate()
+        info = snapshot().get(product_id)
+        if info is None:
+            from nest_app.models import Product
+            raise Product.DoesNotExist
+    return info
+
+
+def mass_g(product_id):
+    return get(product_id).mass_g
+
+
+def sync():
+    """Drop the snapshot if the catalog was changed in the database since it was last checked, with one query
+
+    Signals only reach this process, so entry points that pack or weigh shipments call this first to see
+    changes made by other web workers or fulfillment workers.
+    """
+
+    global _stored_version
+    from nest_app.models import CatalogVersion
+
+    stored_version = CatalogVersion.current()
+    if stored_version != _stored_version:
+        invalidate()
+        _stored_version = stored_version
+
+
+def invalidate():
+    global _version, _snapshot, _stored_version
+    with _lock:
+        _version += 1
+        _snapshot = None
+        # the next sync reloads whatever the stored version is
+        _stored_version = None
+
+
+@receiver(catalog_changed)
+def catalog_version_changed(sender, **kwargs):
+    from nest_app.models import CatalogVersion
+
+    # other processes see the change on their next sync
+    CatalogVersion.bump()
+    invalidate()
+
+
+@receiver(post_save, sender="nest_app.Product")
+@receiver(post_delete, sender="nest_app.Product")
+def product_changed(sender, instance, **kwargs):
+    # covers single saves such as admin edits; bulk writes send catalog_changed themselves
+    catalog_changed.send(sender=sender)
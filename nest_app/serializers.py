@@ -4,9 +4,12 @@ from nest_app import models
 
 
 class ProductInventorySerializer(serializers.ModelSerializer):
+    # derived from the last snapshot and the ledger, see ProductInventoryManager
+    quantity = serializers.IntegerField(read_only=True)
+
     class Meta:
         model = models.ProductInventory
-        fields = "__all__"
+        fields = ["id", "product", "quantity"]
 
 
 class OrdersSerializer(serializers.ModelSerializer):
@@ -14,3 +17,60 @@ class OrdersSerializer(serializers.ModelSerializer):
         model = models.Order
         fields = "__all__"
 
+
+class OrderedItemDetailSerializer(serializers.ModelSerializer):
+    product_name = serializers.CharField(source="product.name")
+    mass_g = serializers.IntegerField(source="product.mass_g")
+    quantity_needed = serializers.IntegerField()
+
+    class Meta:
+        model = models.OrderedItem
+        fields = ["id", "product", "product_name", "mass_g", "quantity", "shipped_quantity", "quantity_needed"]
+
+
+class ShippedItemDetailSerializer(serializers.ModelSerializer):
+    product_name = serializers.CharField(source="product.name")
+
+    class Meta:
+        model = models.ShippedItem
+        fields = ["id", "product", "product_name", "quantity"]
+
+
+class ShipmentDetailSerializer(serializers.ModelSerializer):
+    items = ShippedItemDetailSerializer(source="shippeditem_set", many=True, read_only=True)
+    mass_g = serializers.SerializerMethodField()
+
+    class Meta:
+        model = models.Shipment
+        fields = ["id", "mass_g", "items"]
+
+    def get_mass_g(self, shipment):
+        # summed over the prefetched items, Shipment.total_mass would query them again
+        return sum(item.product.mass_g * item.quantity for item in shipment.shippeditem_set.all())
+
+
+class OrderDetailSerializer(serializers.ModelSerializer):
+    """Read-only order with its items and shipments, for querysets prepared with Order.objects.with_details()"""
+
+    items = OrderedItemDetailSerializer(source="ordereditem_set", many=True, read_only=True)
+    shipments = ShipmentDetailSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = models.Order
+        fields = ["id", "status", "items_pending", "total_mass_g", "shipped_mass_g", "items", "shipments"]
+        read_only_fields = fields
+
+
+class RequestedItemSerializer(serializers.Serializer):
+    product_id = serializers.CharField(max_length=50)
+    quantity = serializers.IntegerField(min_value=1)
+
+
+class OrderRequestSerializer(serializers.Serializer):
+    order_id = serializers.CharField(max_length=50)
+    requested = RequestedItemSerializer(many=True, allow_empty=False)
+
+
+class RestockItemSerializer(serializers.Serializer):
+    product_id = serializers.CharField(max_length=50)
+    quantity = serializers.IntegerField(min_value=1)
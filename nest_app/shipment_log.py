@@ -0,0 +1,201 @@
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+DEFAULT_CONFIG = {
+    # "json" for one JSON record per line, "text" for the human-readable shipment manifest
+    "format": "json",
+    # file to append to, stdout when None
+    "path": None,
+    # records held in memory before new ones are dropped
+    "max_queue": 10000,
+    # most records written per batch
+    "batch_size": 500,
+    # seconds between flushes when records trickle in
+    "flush_interval": 1.0,
+    # rotate the file once it grows past max_bytes, keeping backup_count old files
+    "max_bytes": 10 * 1024 * 1024,
+    "backup_count": 5,
+}
+
+
+def shipment_record(shipment_obj, shipped, total_mass):
+    """Structured record for a shipment of (product, quantity) pairs"""
+
+    return {
+        "event": "shipment_deployed",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "shipment_id": shipment_obj.id,
+        "order_id": shipment_obj.order_id,
+        "items": [
+            {"product_id": product.id, "product_name": product.name, "quantity": quantity}
+            for product, quantity in shipped
+        ],
+        "mass_g": total_mass,
+    }
+
+
+def format_json(record):
+    return json.dumps(record, separators=(",", ":")) + "\n"
+
+
+def format_text(record):
+    shipment_items = [(item["product_name"], item["quantity"]) for item in record["items"]]
+    return (f"\n=====================================\n"
+            f"Shipment deployed: \n"
+            f"ID - {record['shipment_id']}\n"
+            f"ORDER ID- {record['order_id']}\n"
+            f"ITEMS/QUANTITY: {shipment_items}\n"
+            f"SHIPMENT WEIGHT (g): {record['mass_g']}\n"
+            f"=====================================\n")
+
+
+FORMATTERS = {
+    "json": format_json,
+    "text": format_text,
+}
+
+
+_STOP = object()
+
+
+class ShipmentLogSink:
+    """Writes shipment records from a background thread in batches
+
+    emit never blocks the caller: records go on a bounded queue, and when the queue is full the record is
+    dropped and counted in dropped.
+    """
+
+    def __init__(self, formatter=format_json, path=None, max_queue=10000, batch_size=500, flush_interval=1.0,
+                 max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.formatter = formatter
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.dropped = 0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stream = None
+        self._thread = threading.Thread(target=self._run, name="shipment-log-sink", daemon=True)
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Block until every record emitted so far has been written"""
+        self._queue.join()
+
+    def close(self):
+        self.flush()
+        # wakes the writer thread straight away instead of after flush_interval
+        self._queue.put(_STOP)
+        self._thread.join()
+        if self._stream is not None and self.path is not None:
+            self._stream.close()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                stopping = True
+            records = [record for record in batch if record is not _STOP]
+            try:
+                if records:
+                    self._write("".join(self.formatter(record) for record in records))
+            except OSError as e:
+                sys.stderr.write(f"Shipment log write failed, {len(records)} records lost: {e}\n")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, text):
+        if self.path is None:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+            return
+
+        if self._stream is None:
+            self._stream = open(self.path, "a", encoding="utf-8")
+        self._stream.write(text)
+        self._stream.flush()
+        if self.max_bytes and self._stream.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._stream.close()
+        self._stream = None
+        if self.backup_count <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    """Process-wide sink configured by NEST_SHIPMENT_LOG, created on first use"""
+
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            config = {**DEFAULT_CONFIG, **getattr(settings, "NEST_SHIPMENT_LOG", {})}
+            _sink = ShipmentLogSink(
+                formatter=FORMATTERS[config["format"]],
+                path=config["path"],
+                max_queue=config["max_queue"],
+                batch_size=config["batch_size"],
+                flush_interval=config["flush_interval"],
+                max_bytes=config["max_bytes"],
+                backup_count=config["backup_count"],
+            )
+        return _sink
+
+
+def emit(record):
+    get_sink().emit(record)
+
+
+def close():
+    global _sink
+    with _sink_lock:
+        sink, _sink = _sink, None
+    if sink is not None:
+        sink.close()
+
+
+def _reset_after_fork():
+    # the writer thread does not survive a fork, so a forked worker starts its own sink
+    global _sink, _sink_lock
+    _sink = None
+    _sink_lock = threading.Lock()
+
+
+atexit.register(close)
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,9 +1,30 @@
-from django.test import TestCase
+from unittest import mock
 
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from nest_app.fulfillment import drain_outbox, MAX_ATTEMPTS
 from nest_app.models import ProductInventory, Product, Order, Shipment, ShippedItem, OrderedItem, ship_package, \
-    log_shipment
-from nest_app.processing import init_catalog, process_restock, process_order
+    log_shipment, create_shipment, FulfillmentTask, CatalogVersion, InventoryMovement, InventorySnapshot, MAX_SHIPMENT_MASS
+from nest_app import idempotency, inventory, products, shipment_log
+from nest_app.allocation import POLICIES, PendingDemand, allocate
+from nest_app.catalog import iter_catalog, load_catalog
+from nest_app.benchmark import compare, generate_catalog, run_scale
+from nest_app.db import retry_on_locked, apply_storage_profile, storage_profile, LOCK_RETRY_ATTEMPTS
+from nest_app.ids import new_id
+from nest_app.packing import plan_packages
+from nest_app.processing import init_catalog, process_restock, process_order, process_orders
+from datetime import timedelta
+import io
 import json
+import os
+import random
+import tempfile
+import threading
 
 product_info = json.loads(open('./test_inventory.json').read())
 
@@ -24,6 +45,13 @@ def order(order_info):
     process_order(order_info)
 
 
+def set_stock(product_id, quantity):
+    """Move a product's stock to quantity behind the inventory cache's back, as another worker would"""
+    delta = quantity - ProductInventory.objects.get(product_id=product_id).quantity
+    InventoryMovement.objects.create(product_id=str(product_id), kind=InventoryMovement.ADJUST, quantity=abs(delta),
+                                     delta=delta)
+
+
 class TestInitializeInventory(TestCase):
     def test_no_data_before_initialize_inventory(self):
         expected = 0
@@ -51,6 +79,159 @@ class TestInitializeInventory(TestCase):
         self.assertEqual(expected, actual)
 
 
+class TestCatalogLoader(TestCase):
+    def write_catalog(self, text):
+        f = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+        f.write(text)
+        f.close()
+        self.addCleanup(os.remove, f.name)
+        return f.name
+
+    def test_reads_json_array_in_small_pieces(self):
+        path = self.write_catalog(json.dumps(product_info, indent=2))
+
+        expected = product_info
+        actual = list(iter_catalog(path, read_size=7))
+        self.assertEqual(expected, actual)
+
+    def test_reads_one_product_per_line(self):
+        path = self.write_catalog("".join(json.dumps(product) + "\n" for product in product_info))
+
+        expected = product_info
+        actual = list(iter_catalog(path, read_size=16))
+        self.assertEqual(expected, actual)
+
+    def test_truncated_catalog_is_an_error(self):
+        path = self.write_catalog(json.dumps(product_info)[:-20])
+
+        with self.assertRaises(ValueError):
+            list(iter_catalog(path))
+
+    def test_load_creates_products_and_empty_inventory_in_chunks(self):
+        # per chunk: savepoint, read products, insert products, read inventory, insert inventory, release;
+        # then the catalog version bump
+        with self.assertNumQueries(6 * 5 + 1):
+            counts = load_catalog(product_info, chunk_size=3)
+
+        self.assertEqual({"created": len(product_info), "updated": 0, "unchanged": 0}, counts)
+        self.assertEqual(len(product_info), ProductInventory.objects.filter(quantity=0).count())
+
+    def test_reload_is_idempotent_and_keeps_stock(self):
+        initialize_inventory()
+        restock([{"product_id": 0, "quantity": 5}])
+
+        # savepoint, read the products and their inventory rows, release: nothing written
+        with self.assertNumQueries(4):
+            counts = load_catalog(product_info)
+
+        self.assertEqual({"created": 0, "updated": 0, "unchanged": len(product_info)}, counts)
+        self.assertEqual(5, ProductInventory.objects.get(product_id=0).quantity)
+        self.assertEqual(len(product_info), ProductInventory.objects.count())
+
+    def test_reload_updates_only_changed_products(self):
+        initialize_inventory()
+        changed = [dict(product, mass_g=product["mass_g"] + 1) if product["product_id"] == 0 else product
+                   for product in product_info]
+        changed.append({"product_id": 99, "product_name": "New product", "mass_g": 100})
+
+        counts = load_catalog(changed)
+
+        self.assertEqual({"created": 1, "updated": 1, "unchanged": len(product_info) - 1}, counts)
+        self.assertEqual(701, Product.objects.get(id=0).mass_g)
+        self.assertEqual(0, ProductInventory.objects.get(product_id=99).quantity)
+
+    def test_command_loads_catalog_from_path(self):
+        path = self.write_catalog(json.dumps(product_info))
+        out = io.StringIO()
+
+        call_command("initialize_inventory", path, stdout=out)
+        call_command("initialize_inventory", path, stdout=out)
+
+        self.assertEqual(len(product_info), ProductInventory.objects.count())
+        self.assertIn(f"0 products created, 0 updated, {len(product_info)} unchanged.", out.getvalue())
+
+
+class TestProductCatalogCache(TestCase):
+    def setUp(self):
+        initialize_inventory()
+
+    def test_catalog_is_loaded_once(self):
+        with self.assertNumQueries(1):
+            products.snapshot()
+            products.mass_g(0)
+            products.get(10)
+
+    def test_snapshot_is_immutable(self):
+        with self.assertRaises(TypeError):
+            products.snapshot()["0"] = products.ProductInfo("0", "Changed", 1)
+
+    def test_catalog_load_with_changes_moves_version_on(self):
+        version = products.version()
+        load_catalog(product_info)
+        self.assertEqual(version, products.version())
+
+        load_catalog([dict(product_info[0], mass_g=10)])
+
+        self.assertNotEqual(version, products.version())
+        self.assertEqual(10, products.mass_g(0))
+
+    def test_product_edit_invalidates_catalog(self):
+        products.snapshot()
+        product = Product.objects.get(id=0)
+        product.name = "Renamed"
+        product.save()
+
+        self.assertEqual("Renamed", products.get(0).name)
+
+    def test_unknown_product_raises(self):
+        with self.assertRaises(Product.DoesNotExist):
+            products.get(100)
+
+    def change_in_other_process(self, product_id, mass_g):
+        # bulk updates send no signals, as if another process had made the change
+        Product.objects.filter(id=product_id).update(mass_g=mass_g)
+        CatalogVersion.objects.filter(id=1).update(version=F("version") + 1)
+
+    def test_sync_sees_change_made_by_another_process(self):
+        products.snapshot()
+        self.change_in_other_process(0, 10)
+
+        self.assertEqual(700, products.mass_g(0))
+        products.sync()
+        self.assertEqual(10, products.mass_g(0))
+
+    def test_shipment_is_weighed_with_mass_changed_by_another_process(self):
+        order({"order_id": 1, "requested": [{"product_id": 1, "quantity": 1}]})
+        products.snapshot()
+        self.change_in_other_process(1, MAX_SHIPMENT_MASS)
+
+        with self.assertRaises(Exception):
+            ship({"order_id": 1, "shipped": [{"product_id": 1, "quantity": 1}]})
+        self.assertEqual(0, Shipment.objects.count())
+
+    def test_batch_packs_with_mass_changed_by_another_process(self):
+        restock([{"product_id": 1, "quantity": 2}])
+        products.snapshot()
+        self.change_in_other_process(1, 1000)
+
+        process_orders([{"order_id": 1, "requested": [{"product_id": 1, "quantity": 2}]}])
+
+        expected = [1000, 1000]
+        actual = [shipment.total_mass for shipment in Shipment.objects.filter(order_id=1)]
+        self.assertEqual(expected, actual)
+
+    def test_mass_arithmetic_reads_no_products(self):
+        restock([{"product_id": 0, "quantity": 2}])
+        order({"order_id": 1, "requested": [{"product_id": 0, "quantity": 2}, {"product_id": 10, "quantity": 1}]})
+        ordered_items = list(OrderedItem.objects.filter(order_id=1))
+        shipment = Shipment.objects.get(order_id=1)
+        products.snapshot()
+
+        with self.assertNumQueries(1):
+            self.assertEqual([1400, 300], [item.total_mass for item in ordered_items])
+            self.assertEqual(1400, shipment.total_mass)
+
+
 class TestProductInventory(TestCase):
     def setUp(self):
         initialize_inventory()
@@ -105,6 +286,21 @@ class TestRestock(TestCase):
         self.assertEqual(expected_id_0, actual_id_0)
         self.assertEqual(expected_id_6, actual_id_6)
 
+    def test_restock_adds_to_quantity_left_from_earlier_restock(self):
+        restock([self.product_id_0])
+        restock([self.product_id_0_partial_restock_4])
+
+        expected = 34
+        actual = ProductInventory.objects.get(product_id=0).quantity
+        self.assertEqual(expected, actual)
+
+    def test_restock_of_same_product_twice_in_one_call_adds_both_quantities(self):
+        restock([self.product_id_0_partial_restock_1, self.product_id_0_partial_restock_4])
+
+        expected = 5
+        actual = ProductInventory.objects.get(product_id=0).quantity
+        self.assertEqual(expected, actual)
+
     def test_no_shipment_created_on_restock_if_no_pending_order_items(self):
         restock([self.product_id_0, self.product_id_6])
         expected = 0
@@ -319,6 +515,291 @@ class TestRestock(TestCase):
         self.assertEqual(expected, actual)
 
 
+class TestOrderCounters(TestCase):
+    def setUp(self):
+        initialize_inventory()
+        self.test_order = {
+            "order_id": 1100,
+            "requested": [{"product_id": 0, "quantity": 2}, {"product_id": 10, "quantity": 4}]
+        }
+
+    def test_counters_set_when_order_created(self):
+        order(self.test_order)
+
+        order_obj = Order.objects.get(id=1100)
+        self.assertEqual((Order.PENDING, 2, 2600, 0),
+                         (order_obj.status, order_obj.items_pending, order_obj.total_mass_g, order_obj.shipped_mass_g))
+
+    def test_counters_updated_as_items_ship(self):
+        order(self.test_order)
+        restock([{"product_id": 0, "quantity": 2}])
+
+        order_obj = Order.objects.get(id=1100)
+        self.assertEqual((Order.PENDING, 1, 1400), (order_obj.status, order_obj.items_pending, order_obj.shipped_mass_g))
+
+        restock([{"product_id": 10, "quantity": 4}])
+
+        order_obj = Order.objects.get(id=1100)
+        self.assertEqual((Order.COMPLETED, 0, 2600), (order_obj.status, order_obj.items_pending, order_obj.shipped_mass_g))
+
+    def test_batch_orders_get_counters(self):
+        restock([{"product_id": 0, "quantity": 2}])
+        process_orders([self.test_order])
+
+        order_obj = Order.objects.get(id=1100)
+        self.assertEqual((Order.PENDING, 1, 1400), (order_obj.status, order_obj.items_pending, order_obj.shipped_mass_g))
+
+    def test_empty_order_in_batch_is_completed(self):
+        restock([{"product_id": 0, "quantity": 2}])
+        process_orders([self.test_order, {"order_id": 1103, "requested": []}])
+
+        order_obj = Order.objects.get(id=1103)
+        self.assertEqual((Order.COMPLETED, 0, 0, 0),
+                         (order_obj.status, order_obj.items_pending, order_obj.total_mass_g, order_obj.shipped_mass_g))
+
+    def test_update_quantity_keeps_order_counters(self):
+        order_obj = Order.objects.create(id=1101)
+        item = OrderedItem.objects.create(product_id=0, order=order_obj, quantity=2)
+
+        item.update_quantity(2)
+
+        order_obj = Order.objects.get(id=1101)
+        self.assertTrue(item.shipped)
+        self.assertEqual((Order.COMPLETED, 0, 1400), (order_obj.status, order_obj.items_pending, order_obj.shipped_mass_g))
+
+    def test_items_created_directly_count_towards_order(self):
+        order_obj = Order.objects.create(id=1101)
+        OrderedItem.objects.create(product_id=0, order=order_obj, quantity=2)
+
+        order_obj = Order.objects.get(id=1101)
+        self.assertEqual((Order.PENDING, 1, 1400), (order_obj.status, order_obj.items_pending, order_obj.total_mass_g))
+
+    def test_pending_orders_listed_with_one_query(self):
+        restock([{"product_id": 0, "quantity": 2}, {"product_id": 10, "quantity": 4}])
+        order(self.test_order)
+        order({"order_id": 1102, "requested": [{"product_id": 6, "quantity": 1}]})
+
+        with self.assertNumQueries(1):
+            expected = ["1102"]
+            actual = [order_obj.id for order_obj in Order.objects.pending()]
+        self.assertEqual(expected, actual)
+
+
+class TestAllocation(SimpleTestCase):
+    def demand(self, blocked_orders=()):
+        # (item id, order id, product id, quantity, shipped quantity), oldest first
+        return PendingDemand([
+            ("a", "o1", "0", 5, 0),
+            ("b", "o2", "0", 2, 0),
+            ("c", "o2", "6", 3, 1),
+            ("d", "o3", "0", 1, 0),
+            ("e", "o3", "6", 2, 0),
+        ], blocked_orders)
+
+    def allocated(self, plan):
+        return {item_id: quantity for item_id, _, _, quantity in plan.allocations()}
+
+    def test_fifo_fills_oldest_first_and_partially_fills_the_boundary_item(self):
+        plan = allocate(self.demand(), {"0": 6, "6": 3}, "fifo")
+
+        self.assertEqual({"a": 5, "b": 1, "c": 2, "e": 1}, self.allocated(plan))
+        self.assertEqual({"0": 6, "6": 3}, plan.allocated())
+
+    def test_smallest_first_fills_the_most_items(self):
+        plan = allocate(self.demand(), {"0": 3, "6": 2}, "smallest_first")
+
+        self.assertEqual({"d": 1, "b": 2, "c": 2}, self.allocated(plan))
+
+    def test_max_completed_orders_favours_orders_that_can_complete(self):
+        plan = allocate(self.demand(), {"0": 3, "6": 2}, "max_completed_orders")
+
+        # o3 needs 3 in all, o2 needs 4, o1 needs 5
+        self.assertEqual({"d": 1, "e": 2, "b": 2}, self.allocated(plan))
+
+    def test_max_completed_orders_puts_blocked_orders_last(self):
+        plan = allocate(self.demand(blocked_orders={"o3"}), {"0": 3, "6": 2}, "max_completed_orders")
+
+        self.assertEqual({"b": 2, "c": 2, "a": 1}, self.allocated(plan))
+
+    def test_never_allocates_more_than_needed_or_available(self):
+        plan = allocate(self.demand(), {"0": 100}, "fifo")
+
+        self.assertEqual({"a": 5, "b": 2, "d": 1}, self.allocated(plan))
+        self.assertEqual({"0": 8, "6": 4}, self.demand().totals())
+
+    def test_empty_demand(self):
+        self.assertEqual([], allocate(PendingDemand([]), {"0": 5}).allocations())
+
+    def test_unknown_policy_is_rejected(self):
+        with self.assertRaises(ValueError):
+            allocate(self.demand(), {"0": 1}, "random")
+
+    def test_large_backlog_allocates_in_one_pass(self):
+        rng = random.Random(0)
+        rows = [(str(i), str(i // 3), str(rng.randrange(13)), rng.randint(1, 5), 0) for i in range(50000)]
+        demand = PendingDemand(rows)
+        available = {product_id: total // 2 for product_id, total in demand.totals().items()}
+
+        for policy in POLICIES:
+            plan = allocate(demand, available, policy)
+            self.assertEqual(available, plan.allocated())
+
+
+class TestRestockAllocation(TestCase):
+    def setUp(self):
+        initialize_inventory()
+        order({"order_id": 1, "requested": [{"product_id": 0, "quantity": 2}, {"product_id": 6, "quantity": 5}]})
+        order({"order_id": 2, "requested": [{"product_id": 0, "quantity": 1}]})
+
+    def test_restock_allocates_oldest_first_by_default(self):
+        restock([{"product_id": 0, "quantity": 2}])
+
+        self.assertEqual(2, OrderedItem.objects.get(order_id=1, product_id=0).shipped_quantity)
+        self.assertFalse(Order.objects.get(id=2).completed)
+
+    def test_restock_with_policy(self):
+        process_restock([{"product_id": 0, "quantity": 2}], policy="max_completed_orders")
+
+        # order 1 still waits on product 6, so order 2 is completed first
+        self.assertTrue(Order.objects.get(id=2).completed)
+        self.assertEqual(1, OrderedItem.objects.get(order_id=1, product_id=0).shipped_quantity)
+        self.assertEqual(0, ProductInventory.objects.get(product_id=0).quantity)
+
+    @override_settings(NEST_ALLOCATION_POLICY="smallest_first")
+    def test_policy_setting(self):
+        restock([{"product_id": 0, "quantity": 1}])
+
+        self.assertTrue(Order.objects.get(id=2).completed)
+
+    def test_restock_reads_pending_demand_with_fixed_queries(self):
+        for order_id in range(10, 30):
+            order({"order_id": order_id, "requested": [{"product_id": 10, "quantity": 1}]})
+
+        with CaptureQueriesContext(connection) as queries:
+            restock([{"product_id": 10, "quantity": 20}])
+        selects = [query["sql"] for query in queries if query["sql"].startswith("SELECT")]
+        # catalog version, stock, pending demand, blocked orders, items to ship, snapshot check
+        self.assertLessEqual(len(selects), 6)
+
+
+class TestConsolidatedRestock(TestCase):
+    def setUp(self):
+        initialize_inventory()
+        # 300 g + 2 * 80 g + 350 g, all of it fits in one package
+        order({"order_id": 1, "requested": [
+            {"product_id": 10, "quantity": 1}, {"product_id": 7, "quantity": 2}, {"product_id": 4, "quantity": 1}
+        ]})
+        self.restock = [{"product_id": 10, "quantity": 1}, {"product_id": 7, "quantity": 2}, {"product_id": 4, "quantity": 1}]
+
+    def test_items_freed_for_one_order_ship_together(self):
+        process_restock(self.restock, consolidate=True)
+
+        self.assertEqual(1, Shipment.objects.filter(order_id=1).count())
+        self.assertTrue(Order.objects.get(id=1).completed)
+
+    def test_per_item_restock_ships_every_item_on_its_own(self):
+        process_restock(self.restock, consolidate=False)
+
+        self.assertEqual(3, Shipment.objects.filter(order_id=1).count())
+        self.assertTrue(Order.objects.get(id=1).completed)
+
+    @override_settings(NEST_RESTOCK_SHIPMENTS="per_item")
+    def test_restock_shipments_setting(self):
+        restock(self.restock)
+
+        self.assertEqual(3, Shipment.objects.filter(order_id=1).count())
+
+    def test_consolidated_shipments_stay_under_max_mass(self):
+        order({"order_id": 2, "requested": [{"product_id": 0, "quantity": 2}, {"product_id": 1, "quantity": 2}]})
+
+        restock([{"product_id": 0, "quantity": 2}, {"product_id": 1, "quantity": 2}])
+
+        shipments = Shipment.objects.filter(order_id=2)
+        self.assertEqual(2, len(shipments))
+        self.assertTrue(all(shipment.total_mass < MAX_SHIPMENT_MASS for shipment in shipments))
+
+
+class TestIdempotencyIndex(TestCase):
+    def setUp(self):
+        initialize_inventory()
+        idempotency.clear()
+        self.addCleanup(idempotency.clear)
+
+    def submit(self, order_id):
+        order_info = {"order_id": str(order_id), "requested": [{"product_id": 0, "quantity": 1}]}
+        with self.captureOnCommitCallbacks(execute=True):
+            process_orders([order_info], [idempotency.request_key(order_id)])
+        return order_info
+
+    @override_settings(NEST_IDEMPOTENCY_CACHE_SIZE=2)
+    def test_index_keeps_most_recent_keys_in_memory(self):
+        for order_id in range(3):
+            self.submit(order_id)
+
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(idempotency.lookup("order:2"))
+        # dropped from memory, read back from the database
+        with self.assertNumQueries(1):
+            entry = idempotency.lookup("order:0")
+        self.assertEqual("0", entry.result["id"])
+
+    def test_lookup_many_reads_missing_keys_in_one_query(self):
+        orders = [self.submit(order_id) for order_id in range(3)]
+        idempotency.clear()
+
+        with self.assertNumQueries(1):
+            entries = idempotency.lookup_many(["order:0", "order:1", "order:9"])
+
+        self.assertEqual({"order:0", "order:1"}, set(entries))
+        self.assertEqual(idempotency.fingerprint(orders[0]), entries["order:0"].fingerprint)
+
+    def test_resent_order_returns_the_order_it_created(self):
+        restock([{"product_id": 0, "quantity": 5}])
+        order_info = {"order_id": "1", "requested": [{"product_id": 0, "quantity": 2}]}
+        first = process_order(order_info)
+
+        again = process_order(order_info)
+
+        self.assertEqual(first.id, again.id)
+        self.assertEqual(1, Shipment.objects.count())
+        self.assertEqual(3, ProductInventory.objects.get(product_id=0).quantity)
+
+    def test_resent_order_id_with_other_items_is_rejected(self):
+        process_order({"order_id": "1", "requested": [{"product_id": 0, "quantity": 2}]})
+
+        with self.assertRaises(IntegrityError):
+            process_order({"order_id": "1", "requested": [{"product_id": 0, "quantity": 3}]})
+
+    def test_batch_processes_only_orders_not_seen_before(self):
+        orders = [self.submit(0), {"order_id": "1", "requested": [{"product_id": 0, "quantity": 1}]}]
+
+        order_objs = process_orders(orders)
+
+        self.assertEqual(["0", "1"], [order_obj.id for order_obj in order_objs])
+        self.assertEqual(2, Order.objects.count())
+
+
+class TestPendingItems(TestCase):
+    def setUp(self):
+        initialize_inventory()
+        order({"order_id": 501, "requested": [{"product_id": 0, "quantity": 2}]})
+        order({"order_id": 502, "requested": [{"product_id": 0, "quantity": 2}]})
+
+    def test_pending_excludes_shipped_items(self):
+        restock([{"product_id": 0, "quantity": 2}])
+
+        expected = ["502"]
+        actual = [item.order_id for item in OrderedItem.objects.filter(product_id=0).pending()]
+        self.assertEqual(expected, actual)
+
+    def test_restock_fills_oldest_pending_item_first(self):
+        restock([{"product_id": 0, "quantity": 3}])
+
+        expected = [0, 1]
+        actual = [item.quantity_needed for item in OrderedItem.objects.filter(product_id=0).order_by("created_at")]
+        self.assertEqual(expected, actual)
+
+
 class TestOrder(TestCase):
     def setUp(self):
         initialize_inventory()
@@ -442,6 +923,27 @@ class TestShipment(TestCase):
         actual = len(Shipment.objects.all())
         self.assertEqual(expected, actual)
 
+    def test_create_shipment_query_count_does_not_grow_with_items(self):
+        shipped = [(product, 1) for product in Product.objects.filter(mass_g__lt=200)]
+
+        # shipment insert, bulk shipped item insert and bulk ship movement insert, inside a savepoint
+        with self.assertNumQueries(5):
+            create_shipment(self.order, shipped)
+        self.assertEqual(len(shipped), len(ShippedItem.objects.all()))
+
+    def test_ship_package_reads_products_from_catalog_cache(self):
+        products.sync()
+        products.snapshot()
+
+        # catalog version, order, then savepoint, shipment, shipped items, ship movements and release
+        with self.assertNumQueries(7):
+            ship(self.test_package)
+
+    def test_overweight_shipment_writes_nothing(self):
+        with self.assertRaises(Exception):
+            create_shipment(self.order, [(self.product, 3)])
+        self.assertEqual(0, len(Shipment.objects.all()))
+
     def test_shipment_object_is_created_with_correct_shipped_item_when_ship_package_is_called_for_order_with_1_item(self):
         ship(self.test_package)
 
@@ -450,6 +952,517 @@ class TestShipment(TestCase):
         self.assertEqual(expected, actual)
 
 
+class TestShipmentLog(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "shipments.log")
+        self.record = {
+            "event": "shipment_deployed",
+            "shipment_id": "S1",
+            "order_id": "123",
+            "items": [{"product_id": "0", "product_name": "RBC A+ Adult", "quantity": 2}],
+            "mass_g": 1400,
+        }
+
+    def read_lines(self, path):
+        with open(path) as f:
+            return f.read().splitlines()
+
+    def test_sink_writes_json_records(self):
+        sink = shipment_log.ShipmentLogSink(path=self.path)
+        sink.emit(self.record)
+        sink.emit(self.record)
+        sink.close()
+
+        expected = [self.record, self.record]
+        actual = [json.loads(line) for line in self.read_lines(self.path)]
+        self.assertEqual(expected, actual)
+
+    def test_text_formatter_keeps_manifest_format(self):
+        expected = ("\n=====================================\n"
+                    "Shipment deployed: \n"
+                    "ID - S1\n"
+                    "ORDER ID- 123\n"
+                    "ITEMS/QUANTITY: [('RBC A+ Adult', 2)]\n"
+                    "SHIPMENT WEIGHT (g): 1400\n"
+                    "=====================================\n")
+        self.assertEqual(expected, shipment_log.format_text(self.record))
+
+    def test_sink_rotates_file_past_max_bytes(self):
+        sink = shipment_log.ShipmentLogSink(path=self.path, max_bytes=1, batch_size=1)
+        sink.emit(self.record)
+        sink.emit(self.record)
+        sink.close()
+
+        self.assertEqual(1, len(self.read_lines(self.path + ".1")))
+        self.assertEqual(1, len(self.read_lines(self.path + ".2")))
+
+    def test_full_queue_drops_records_without_blocking(self):
+        sink = shipment_log.ShipmentLogSink(path=self.path, max_queue=1)
+        sink._queue.put_nowait(self.record)
+        with mock.patch.object(sink._queue, "put_nowait", side_effect=shipment_log.queue.Full):
+            sink.emit(self.record)
+        sink.close()
+
+        self.assertEqual(1, sink.dropped)
+
+    def test_committed_shipment_is_emitted(self):
+        initialize_inventory()
+        order_obj = Order.objects.create(id=123)
+        product = Product.objects.get(id=0)
+
+        with mock.patch("nest_app.shipment_log.emit") as emit:
+            with self.captureOnCommitCallbacks(execute=True):
+                shipment = create_shipment(order_obj, [(product, 2)])
+
+        record = emit.call_args[0][0]
+        self.assertEqual(shipment.id, record["shipment_id"])
+        self.assertEqual(1400, record["mass_g"])
+        self.assertEqual([{"product_id": "0", "product_name": product.name, "quantity": 2}], record["items"])
+
+
+class TestPacking(TestCase):
+    def setUp(self):
+        initialize_inventory()
+        self.mixed_order = {
+            "order_id": 200,
+            "requested": [
+                {"product_id": 0, "quantity": 5},
+                {"product_id": 8, "quantity": 10},
+                {"product_id": 10, "quantity": 3}
+            ]
+        }
+
+    def test_plan_packages_keeps_every_package_below_max_mass(self):
+        packages = plan_packages([("rbc", 700, 5), ("cryo", 40, 10)], 1800)
+        self.assertTrue(all(package["mass_g"] < 1800 for package in packages))
+        self.assertEqual(3, len(packages))
+
+    def test_plan_packages_places_lighter_items_in_open_packages_first(self):
+        packages = plan_packages([("cryo", 40, 9), ("rbc", 700, 2)], 1800)
+        expected = [{"mass_g": 1760, "items": [("rbc", 2), ("cryo", 9)]}]
+        self.assertEqual(expected, packages)
+
+    def test_plan_packages_rejects_item_heavier_than_max_mass(self):
+        with self.assertRaises(Exception):
+            plan_packages([("heavy", 1800, 1)], 1800)
+
+    def test_available_items_are_packed_together_when_part_of_order_is_backordered(self):
+        restock([{"product_id": 0, "quantity": 5}, {"product_id": 8, "quantity": 10}])
+
+        order(self.mixed_order)
+
+        expected = 3
+        actual = len(Shipment.objects.filter(order_id=200))
+        self.assertEqual(expected, actual)
+
+        expected = [0, 0, 3]
+        actual = [item.quantity_needed for item in Order.objects.get(id=200).items]
+        self.assertEqual(expected, actual)
+
+    def test_shipped_items_match_ordered_quantities_when_packed(self):
+        restock([{"product_id": 0, "quantity": 5}, {"product_id": 8, "quantity": 10}])
+
+        order(self.mixed_order)
+
+        shipped = {}
+        for item in ShippedItem.objects.filter(order_id=200):
+            shipped[item.product.id] = shipped.get(item.product.id, 0) + item.quantity
+        self.assertEqual({"0": 5, "8": 10}, shipped)
+
+
+class TestIds(TestCase):
+    def test_ids_are_unique_and_strictly_increasing(self):
+        ids = [new_id() for _ in range(10000)]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(ids, sorted(ids))
+
+    def test_ids_fit_primary_key_column(self):
+        self.assertEqual(26, len(new_id()))
+
+    def test_shipments_get_generated_ids(self):
+        initialize_inventory()
+        restock([{"product_id": 0, "quantity": 4}])
+        order({"order_id": 600, "requested": [{"product_id": 0, "quantity": 4}]})
+
+        ids = [shipment.id for shipment in Shipment.objects.filter(order_id=600).order_by("id")]
+        self.assertEqual(2, len(ids))
+        self.assertTrue(all(len(shipment_id) == 26 for shipment_id in ids))
+
+
+class TestInventoryCache(TestCase):
+    def setUp(self):
+        initialize_inventory()
+
+    def test_cached_read_does_not_query_database(self):
+        inventory.get_quantity(0)
+        with self.assertNumQueries(0):
+            inventory.get_quantity(0)
+
+    def test_decrement_writes_through_to_table(self):
+        restock([{"product_id": 0, "quantity": 30}])
+        inventory.adjust_quantity(inventory.get_inventory(0), -5)
+
+        expected = 25
+        actual = ProductInventory.objects.get(product_id=0).quantity
+        self.assertEqual(expected, actual)
+        self.assertEqual(expected, inventory.get_quantity(0))
+
+    def test_external_save_invalidates_cached_quantity(self):
+        inventory.get_quantity(0)
+        inventory_product = ProductInventory.objects.get(product_id=0)
+        inventory_product.snapshot_quantity = 12
+        inventory_product.save()
+
+        expected = 12
+        actual = inventory.get_quantity(0)
+        self.assertEqual(expected, actual)
+
+    def test_invalidate_reloads_from_database(self):
+        inventory.get_quantity(0)
+        set_stock(0, 7)
+        inventory.invalidate(0)
+
+        expected = 7
+        actual = inventory.get_quantity(0)
+        self.assertEqual(expected, actual)
+
+    def test_rows_are_cached_per_thread(self):
+        inventory_product = inventory.get_inventory(0)
+        cached = []
+        thread = threading.Thread(target=lambda: cached.append(dict(inventory._cache())))
+        thread.start()
+        thread.join()
+
+        self.assertEqual([{}], cached)
+        self.assertIs(inventory_product, inventory.get_inventory(0))
+
+    def test_invalidate_from_another_thread_reloads_from_database(self):
+        inventory.get_quantity(0)
+        set_stock(0, 7)
+        thread = threading.Thread(target=inventory.invalidate)
+        thread.start()
+        thread.join()
+
+        expected = 7
+        actual = inventory.get_quantity(0)
+        self.assertEqual(expected, actual)
+
+    def test_inventory_decremented_when_pending_item_fulfilled_on_restock(self):
+        order({"order_id": 300, "requested": [{"product_id": 0, "quantity": 2}]})
+        restock([{"product_id": 0, "quantity": 5}])
+
+        expected = 3
+        actual = ProductInventory.objects.get(product_id=0).quantity
+        self.assertEqual(expected, actual)
+
+
+class TestBatchOrders(TestCase):
+    def setUp(self):
+        initialize_inventory()
+        self.orders = [
+            {"order_id": 401, "requested": [{"product_id": 0, "quantity": 2}, {"product_id": 8, "quantity": 3}]},
+            {"order_id": 402, "requested": [{"product_id": 0, "quantity": 2}]},
+            {"order_id": 403, "requested": [{"product_id": 6, "quantity": 1}]},
+        ]
+
+    def test_orders_and_items_created_for_every_order_in_batch(self):
+        process_orders(self.orders)
+
+        self.assertEqual(3, len(Order.objects.all()))
+        self.assertEqual(4, len(OrderedItem.objects.all()))
+
+    def test_stock_allocated_to_orders_in_batch_order(self):
+        restock([{"product_id": 0, "quantity": 3}, {"product_id": 8, "quantity": 3}])
+
+        process_orders(self.orders)
+
+        self.assertTrue(Order.objects.get(id=401).completed)
+        expected = [1]
+        actual = [item.quantity_needed for item in Order.objects.get(id=402).items]
+        self.assertEqual(expected, actual)
+        self.assertEqual(0, ProductInventory.objects.get(product_id=0).quantity)
+
+    def test_shipments_written_for_allocated_items(self):
+        restock([{"product_id": 0, "quantity": 3}, {"product_id": 8, "quantity": 3}])
+
+        process_orders(self.orders)
+
+        self.assertEqual(1, len(Shipment.objects.filter(order_id=401)))
+        self.assertEqual(1, len(Shipment.objects.filter(order_id=402)))
+        self.assertEqual(0, len(Shipment.objects.filter(order_id=403)))
+
+    def test_nothing_written_when_batch_contains_unknown_product(self):
+        restock([{"product_id": 0, "quantity": 3}])
+        orders = self.orders + [{"order_id": 404, "requested": [{"product_id": 100, "quantity": 1}]}]
+
+        with self.assertRaises(Product.DoesNotExist):
+            process_orders(orders)
+
+        self.assertEqual(0, len(Order.objects.all()))
+        self.assertEqual(3, ProductInventory.objects.get(product_id=0).quantity)
+
+
+class TestUnitOfWork(TestCase):
+    def setUp(self):
+        initialize_inventory()
+        restock([{"product_id": 0, "quantity": 5}])
+
+    def test_failed_order_leaves_no_order_items_or_reservations(self):
+        with self.assertRaises(Product.DoesNotExist):
+            order({"order_id": 900, "requested": [{"product_id": 0, "quantity": 2}, {"product_id": 100, "quantity": 1}]})
+
+        self.assertEqual(0, len(Order.objects.filter(id=900)))
+        self.assertEqual(0, len(OrderedItem.objects.all()))
+        self.assertEqual(5, ProductInventory.objects.get(product_id=0).quantity)
+        self.assertEqual(5, inventory.get_quantity(0))
+
+    def test_failed_shipment_rolls_back_order(self):
+        with mock.patch("nest_app.models.create_shipment", side_effect=Exception("drone down")):
+            with self.assertRaises(Exception):
+                order({"order_id": 901, "requested": [{"product_id": 0, "quantity": 2}]})
+
+        self.assertEqual(0, len(Order.objects.filter(id=901)))
+        self.assertEqual(5, ProductInventory.objects.get(product_id=0).quantity)
+
+    @override_settings(NEST_STORAGE_PROFILE={"cache_size": -32000})
+    def test_storage_profile_is_applied_to_connection(self):
+        apply_storage_profile(None, connection)
+
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA cache_size")
+            self.assertEqual(-32000, cursor.fetchone()[0])
+
+    @override_settings(NEST_STORAGE_PROFILE="durable")
+    def test_named_storage_profile_is_looked_up(self):
+        expected = {"journal_mode": "WAL", "synchronous": "FULL"}
+        actual = storage_profile()
+        self.assertEqual(expected, actual)
+
+
+@override_settings(NEST_FULFILLMENT_MODE="outbox")
+class TestFulfillmentOutbox(TestCase):
+    def setUp(self):
+        initialize_inventory()
+        restock([{"product_id": 0, "quantity": 5}])
+        self.test_order = {"order_id": 1000, "requested": [{"product_id": 0, "quantity": 2}]}
+
+    def test_intake_commits_order_and_task_without_shipping(self):
+        order(self.test_order)
+
+        self.assertEqual(1, len(FulfillmentTask.objects.filter(order_id=1000, status=FulfillmentTask.PENDING)))
+        self.assertEqual(0, len(Shipment.objects.all()))
+        self.assertEqual(5, ProductInventory.objects.get(product_id=0).quantity)
+
+    def test_batch_intake_records_task_per_order(self):
+        process_orders([self.test_order, {"order_id": 1001, "requested": [{"product_id": 0, "quantity": 1}]}])
+
+        self.assertEqual(2, len(FulfillmentTask.objects.all()))
+        self.assertEqual(0, len(Shipment.objects.all()))
+
+    def test_worker_ships_queued_order(self):
+        order(self.test_order)
+
+        self.assertEqual(1, drain_outbox())
+
+        self.assertTrue(Order.objects.get(id=1000).completed)
+        self.assertEqual(3, ProductInventory.objects.get(product_id=0).quantity)
+        self.assertEqual(FulfillmentTask.DONE, FulfillmentTask.objects.get(order_id=1000).status)
+
+    def test_failed_task_goes_back_to_outbox_until_attempts_run_out(self):
+        order(self.test_order)
+
+        with mock.patch("nest_app.fulfillment.allocate_order", side_effect=Exception("drone down")):
+            for _ in range(MAX_ATTEMPTS):
+                drain_outbox()
+
+        task = FulfillmentTask.objects.get(order_id=1000)
+        self.assertEqual(FulfillmentTask.FAILED, task.status)
+        self.assertEqual("drone down", task.last_error)
+        self.assertEqual(0, len(Shipment.objects.all()))
+
+    def test_worker_command_drains_outbox(self):
+        order(self.test_order)
+
+        call_command("run_fulfillment_worker", "--processes", "1", "--once", stdout=mock.Mock())
+
+        self.assertTrue(Order.objects.get(id=1000).completed)
+
+
+class TestAtomicReservations(TestCase):
+    def setUp(self):
+        initialize_inventory()
+        restock([{"product_id": 0, "quantity": 5}])
+        self.inventory_product = inventory.get_inventory(0)
+
+    def test_reserve_is_rejected_when_stock_taken_by_another_worker(self):
+        set_stock(0, 1)
+
+        self.assertFalse(inventory.reserve(self.inventory_product, 3))
+        self.assertEqual(1, ProductInventory.objects.get(product_id=0).quantity)
+
+    def test_reserve_up_to_takes_only_what_is_really_in_stock(self):
+        set_stock(0, 2)
+
+        expected = 2
+        actual = inventory.reserve_up_to(self.inventory_product, 4)
+        self.assertEqual(expected, actual)
+        self.assertEqual(0, ProductInventory.objects.get(product_id=0).quantity)
+
+    def test_reserve_up_to_sees_stock_restocked_by_another_worker(self):
+        set_stock(0, 9)
+
+        expected = 8
+        actual = inventory.reserve_up_to(self.inventory_product, 8)
+        self.assertEqual(expected, actual)
+
+    def test_order_never_oversells_stale_cached_stock(self):
+        set_stock(0, 1)
+
+        order({"order_id": 800, "requested": [{"product_id": 0, "quantity": 3}]})
+
+        expected = [2]
+        actual = [item.quantity_needed for item in Order.objects.get(id=800).items]
+        self.assertEqual(expected, actual)
+        self.assertEqual(0, ProductInventory.objects.get(product_id=0).quantity)
+
+
+class TestInventoryLedger(TestCase):
+    def setUp(self):
+        initialize_inventory()
+        restock([{"product_id": 0, "quantity": 5}])
+
+    def test_restock_and_order_only_insert_movements(self):
+        order({"order_id": 900, "requested": [{"product_id": 0, "quantity": 2}]})
+
+        expected = [("restock", 5, 5), ("reserve", 2, -2), ("ship", 2, 0)]
+        actual = list(InventoryMovement.objects.filter(product_id=0).order_by("id").values_list("kind", "quantity", "delta"))
+        self.assertEqual(expected, actual)
+        self.assertEqual(0, ProductInventory.stored.get(product_id=0).snapshot_quantity)
+        self.assertEqual(3, ProductInventory.objects.get(product_id=0).quantity)
+
+    def test_restock_records_every_product_with_one_insert(self):
+        with CaptureQueriesContext(connection) as queries:
+            restock([{"product_id": product_id, "quantity": 2} for product_id in range(13)])
+
+        inserts = [query["sql"] for query in queries if query["sql"].startswith('INSERT INTO "nest_app_inventorymovement"')]
+        self.assertEqual(1, len(inserts))
+        self.assertEqual(7, ProductInventory.objects.get(product_id=0).quantity)
+        self.assertEqual(2, inventory.get_quantity(12))
+
+    def test_snapshot_folds_movements_without_changing_stock(self):
+        order({"order_id": 900, "requested": [{"product_id": 0, "quantity": 2}]})
+
+        self.assertEqual(1, inventory.take_snapshots())
+
+        inventory_product = ProductInventory.objects.get(product_id=0)
+        last_movement_id = InventoryMovement.objects.order_by("-id").first().id
+        self.assertEqual((3, 3, last_movement_id), (
+            inventory_product.quantity, inventory_product.snapshot_quantity, inventory_product.last_movement_id
+        ))
+        self.assertEqual([3], list(InventorySnapshot.objects.filter(product_id=0).values_list("quantity", flat=True)))
+        self.assertEqual(0, inventory.take_snapshots())
+
+    def test_stock_at_reads_past_stock_across_snapshots(self):
+        before_order = timezone.now()
+        order({"order_id": 900, "requested": [{"product_id": 0, "quantity": 2}]})
+        inventory.take_snapshots()
+        restock([{"product_id": 0, "quantity": 4}])
+
+        self.assertEqual(0, inventory.stock_at(0, before_order - timedelta(days=1)))
+        self.assertEqual(5, inventory.stock_at(0, before_order))
+        self.assertEqual(7, inventory.stock_at(0, timezone.now()))
+
+    @override_settings(NEST_INVENTORY_SNAPSHOT_INTERVAL=3)
+    def test_restock_snapshots_once_interval_reached(self):
+        self.assertEqual(0, InventorySnapshot.objects.count())
+
+        order({"order_id": 900, "requested": [{"product_id": 0, "quantity": 2}]})
+        restock([{"product_id": 1, "quantity": 1}])
+
+        self.assertEqual({"0", "1"}, set(InventorySnapshot.objects.values_list("product_id", flat=True)))
+        self.assertEqual(0, inventory.snapshot_if_due())
+
+    def test_snapshot_command(self):
+        restock([{"product_id": 1, "quantity": 1}])
+        stdout = io.StringIO()
+
+        call_command("snapshot_inventory", "1", stdout=stdout)
+
+        self.assertEqual("Snapshotted 1 products.", stdout.getvalue().strip())
+        self.assertEqual(["1"], list(InventorySnapshot.objects.values_list("product_id", flat=True)))
+
+
+class TestRetryOnLocked(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch("nest_app.db.time.sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retries_until_database_is_unlocked(self):
+        func = mock.Mock(side_effect=[OperationalError("database is locked"), "done"])
+
+        self.assertEqual("done", retry_on_locked(func)())
+        self.assertEqual(2, func.call_count)
+        self.assertEqual(1, self.sleep.call_count)
+
+    def test_gives_up_after_bounded_attempts(self):
+        func = mock.Mock(side_effect=OperationalError("database is locked"))
+
+        with self.assertRaises(OperationalError):
+            retry_on_locked(func)()
+        self.assertEqual(LOCK_RETRY_ATTEMPTS, func.call_count)
+
+    def test_other_operational_errors_are_not_retried(self):
+        func = mock.Mock(side_effect=OperationalError("no such table"))
+
+        with self.assertRaises(OperationalError):
+            retry_on_locked(func)()
+        self.assertEqual(1, func.call_count)
+
+    def test_lock_inside_transaction_is_left_to_outer_unit_of_work(self):
+        func = mock.Mock(side_effect=OperationalError("database is locked"))
+
+        with mock.patch.object(connection, "in_atomic_block", True):
+            with self.assertRaises(OperationalError):
+                retry_on_locked(func)()
+        self.assertEqual(1, func.call_count)
+
+
+class TestBenchmark(TestCase):
+    def test_run_scale_reports_throughput_queries_and_latency(self):
+        result = run_scale(20, product_info, restock_every=10, ship_packages=2)
+
+        self.assertEqual(20, result["orders"])
+        self.assertEqual(20, len(Order.objects.all()))
+        stats = result["operations"]["process_order"]
+        self.assertEqual(20, stats["calls"])
+        self.assertTrue(stats["p50_ms"] <= stats["p95_ms"] <= stats["p99_ms"])
+        self.assertTrue(result["queries_per_order"] > 0)
+        self.assertEqual(2, result["operations"]["process_restock"]["calls"])
+
+    def test_run_scale_batches_orders_through_process_orders(self):
+        result = run_scale(20, product_info, restock_every=10, batch_size=4, ship_packages=1)
+
+        self.assertEqual(6, result["operations"]["process_orders"]["calls"])
+        self.assertEqual(20, len(Order.objects.all()))
+
+    def test_generated_catalog_fits_in_a_package(self):
+        catalog = generate_catalog(product_info, 100, "lognormal", random.Random(1))
+
+        self.assertEqual(100, len(catalog))
+        self.assertTrue(all(0 < product["mass_g"] < 1800 for product in catalog))
+
+    def test_compare_flags_metrics_worse_than_tolerance(self):
+        baseline = {"results": {"1000": {"orders_per_sec": 100, "queries_per_order": 10, "operations": {}}}}
+        report = {"results": {"1000": {"orders_per_sec": 80, "queries_per_order": 10.5, "operations": {}}}}
+
+        expected = [("1000", "orders_per_sec", 100, 80, -20.0)]
+        actual = compare(report, baseline, 0.1)
+        self.assertEqual(expected, actual)
+
+
 class E2E(TestCase):
     def setUp(self):
         self.test_order1 = {
@@ -0,0 +1,530 @@
+import asyncio
+import json
+from unittest.mock import patch
+from urllib.parse import urlsplit
+
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+
+from nest_app import idempotency, metrics
+from nest_app.async_processing import database_sync_to_async
+from nest_app.models import IdempotencyRecord, InventoryMovement, Order, OrderedItem, ProductInventory, Shipment
+from nest_app.pagination import KeysetPagination
+from nest_app.processing import init_catalog, process_order, process_orders, process_restock
+
+product_info = json.loads(open('./test_inventory.json').read())
+
+
+def ndjson(orders):
+    return "".join(json.dumps(order) + "\n" for order in orders)
+
+
+def add_heavy_product():
+    init_catalog([{"product_id": 99, "product_name": "Heavy", "mass_g": 2000}])
+    process_restock([{"product_id": 99, "quantity": 1}])
+
+
+def stream_lines(response):
+    return [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+
+
+class TestOrdersView(TestCase):
+    def setUp(self):
+        init_catalog(product_info)
+        self.client = APIClient()
+        # replayed results are kept in memory, which outlives each test's rolled back transaction
+        idempotency.clear()
+        self.addCleanup(idempotency.clear)
+        self.test_order = {
+            "order_id": 123,
+            "requested": [
+                {"product_id": 0, "quantity": 2},
+                {"product_id": 10, "quantity": 4}
+            ]
+        }
+
+    def test_post_order_creates_order(self):
+        response = self.client.post("/api/orders", self.test_order, format="json")
+
+        self.assertEqual(201, response.status_code)
+        expected = {"id": "123", "status": "pending", "items_pending": 2, "total_mass_g": 2600, "shipped_mass_g": 0}
+        self.assertEqual(expected, response.json())
+        self.assertEqual(2, len(OrderedItem.objects.filter(order_id=123)))
+
+    def test_post_order_ships_available_items(self):
+        process_restock([{"product_id": 0, "quantity": 30}, {"product_id": 10, "quantity": 4}])
+
+        self.client.post("/api/orders", self.test_order, format="json")
+
+        self.assertTrue(Order.objects.get(id=123).completed)
+
+    def test_retried_order_returns_original_result(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.client.post("/api/orders", self.test_order, format="json")
+        process_restock([{"product_id": 0, "quantity": 2}])
+
+        with self.assertNumQueries(0):
+            response = self.client.post("/api/orders", self.test_order, format="json")
+
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(first.json(), response.json())
+        self.assertEqual("true", response["Idempotent-Replayed"])
+        self.assertEqual(2, len(OrderedItem.objects.filter(order_id=123)))
+
+    def test_retry_is_answered_from_the_database_after_a_restart(self):
+        self.client.post("/api/orders", self.test_order, format="json")
+        idempotency.clear()
+
+        with self.assertNumQueries(1):
+            response = self.client.post("/api/orders", self.test_order, format="json")
+
+        self.assertEqual(201, response.status_code)
+        self.assertEqual("123", response.json()["id"])
+
+    def test_post_duplicate_order_id_with_different_items_is_rejected(self):
+        self.client.post("/api/orders", self.test_order, format="json")
+        response = self.client.post("/api/orders", {
+            "order_id": 123, "requested": [{"product_id": 6, "quantity": 1}]
+        }, format="json")
+
+        self.assertEqual(409, response.status_code)
+        self.assertEqual(2, len(OrderedItem.objects.filter(order_id=123)))
+
+    def test_idempotency_key_header_identifies_the_request(self):
+        self.client.post("/api/orders", self.test_order, format="json", HTTP_IDEMPOTENCY_KEY="abc")
+        response = self.client.post("/api/orders", self.test_order, format="json", HTTP_IDEMPOTENCY_KEY="abc")
+
+        self.assertEqual(201, response.status_code)
+        self.assertTrue(IdempotencyRecord.objects.filter(key="request:abc").exists())
+
+    def test_rolled_back_order_is_not_remembered(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/api/orders", {
+                "order_id": 123, "requested": [{"product_id": 100, "quantity": 1}]
+            }, format="json")
+
+        self.assertIsNone(idempotency.lookup("order:123"))
+
+    def test_order_processed_directly_is_replayed_under_a_new_key(self):
+        # ids as numbers here, as strings once the request is validated
+        process_orders([self.test_order])
+
+        response = self.client.post("/api/orders", self.test_order, format="json", HTTP_IDEMPOTENCY_KEY="new")
+
+        self.assertEqual(201, response.status_code)
+        self.assertEqual("true", response["Idempotent-Replayed"])
+
+    def test_keyed_order_retried_without_the_key_is_replayed(self):
+        self.client.post("/api/orders", self.test_order, format="json", HTTP_IDEMPOTENCY_KEY="abc")
+
+        response = self.client.post("/api/orders", self.test_order, format="json")
+
+        self.assertEqual(201, response.status_code)
+        self.assertEqual("true", response["Idempotent-Replayed"])
+        self.assertEqual("123", process_order(self.test_order).id)
+
+    def test_post_order_with_unknown_product_writes_nothing(self):
+        response = self.client.post("/api/orders", {
+            "order_id": 111,
+            "requested": [{"product_id": 0, "quantity": 1}, {"product_id": 100, "quantity": 2}]
+        }, format="json")
+
+        self.assertEqual(400, response.status_code)
+        self.assertEqual("Unknown product.", response.json()["detail"])
+        self.assertEqual(0, len(Order.objects.all()))
+
+    def test_post_order_with_item_too_heavy_to_ship_is_rejected(self):
+        add_heavy_product()
+
+        response = self.client.post("/api/orders", {
+            "order_id": 111, "requested": [{"product_id": 99, "quantity": 1}]
+        }, format="json")
+
+        self.assertEqual(400, response.status_code)
+        self.assertEqual("Item is too heavy to ship.", response.json()["detail"])
+        self.assertEqual(0, len(Order.objects.all()))
+
+    def test_post_invalid_order_is_rejected(self):
+        response = self.client.post("/api/orders", {"order_id": 111, "requested": []}, format="json")
+
+        self.assertEqual(400, response.status_code)
+
+
+class TestProductInventoryView(TestCase):
+    def setUp(self):
+        init_catalog(product_info)
+        self.client = APIClient()
+
+    def test_post_restock_adds_quantities(self):
+        process_restock([{"product_id": 0, "quantity": 5}])
+
+        response = self.client.post("/api/inventory", [
+            {"product_id": 0, "quantity": 10},
+            {"product_id": 6, "quantity": 8}
+        ], format="json")
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(15, ProductInventory.objects.get(product_id=0).quantity)
+        self.assertEqual(8, ProductInventory.objects.get(product_id=6).quantity)
+
+    def test_post_restock_ships_pending_items_of_every_restocked_product(self):
+        self.client.post("/api/orders", {
+            "order_id": 123,
+            "requested": [{"product_id": 0, "quantity": 2}, {"product_id": 6, "quantity": 2}]
+        }, format="json")
+
+        self.client.post("/api/inventory", [
+            {"product_id": 0, "quantity": 2},
+            {"product_id": 6, "quantity": 2}
+        ], format="json")
+
+        self.assertTrue(Order.objects.get(id=123).completed)
+        self.assertEqual(0, ProductInventory.objects.get(product_id=0).quantity)
+
+    def test_post_restock_with_unknown_product_changes_nothing(self):
+        response = self.client.post("/api/inventory", [
+            {"product_id": 0, "quantity": 10},
+            {"product_id": 100, "quantity": 8}
+        ], format="json")
+
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(0, ProductInventory.objects.get(product_id=0).quantity)
+
+
+class TestBulkOrdersView(TestCase):
+    def setUp(self):
+        init_catalog(product_info)
+        self.client = APIClient()
+        idempotency.clear()
+        self.addCleanup(idempotency.clear)
+        process_restock([{"product_id": 0, "quantity": 30}])
+        self.orders = [
+            {"order_id": order_id, "requested": [{"product_id": 0, "quantity": 1}]}
+            for order_id in range(700, 710)
+        ]
+
+    def post_ndjson(self, body):
+        return self.client.generic("POST", "/api/orders", body, content_type="application/x-ndjson")
+
+    def test_bulk_post_streams_one_result_per_order(self):
+        response = self.post_ndjson(ndjson(self.orders))
+
+        expected = [{"order_id": str(order_id), "status": "created"} for order_id in range(700, 710)]
+        self.assertEqual(expected, stream_lines(response))
+        self.assertEqual(10, len(Shipment.objects.all()))
+        self.assertEqual(20, ProductInventory.objects.get(product_id=0).quantity)
+
+    def test_bad_order_in_bulk_post_only_fails_itself(self):
+        orders = self.orders[:2] + [{"order_id": 799, "requested": [{"product_id": 100, "quantity": 1}]}]
+
+        results = stream_lines(self.post_ndjson(ndjson(orders)))
+
+        expected = ["created", "created", "error"]
+        self.assertEqual(expected, [result["status"] for result in results])
+        self.assertEqual("Unknown product.", results[2]["detail"])
+        self.assertEqual(2, len(Order.objects.all()))
+
+    def test_item_too_heavy_in_bulk_post_reports_same_error_as_single_post(self):
+        add_heavy_product()
+        orders = self.orders[:1] + [{"order_id": 799, "requested": [{"product_id": 99, "quantity": 1}]}]
+
+        results = stream_lines(self.post_ndjson(ndjson(orders)))
+
+        self.assertEqual(["created", "error"], [result["status"] for result in results])
+        self.assertEqual("Item is too heavy to ship.", results[1]["detail"])
+
+    def test_retried_bulk_post_replays_created_orders(self):
+        stream_lines(self.post_ndjson(ndjson(self.orders[:5])))
+
+        results = stream_lines(self.post_ndjson(ndjson(self.orders)))
+
+        expected = ["replayed"] * 5 + ["created"] * 5
+        self.assertEqual(expected, [result["status"] for result in results])
+        self.assertEqual(10, len(Shipment.objects.all()))
+        self.assertEqual(20, ProductInventory.objects.get(product_id=0).quantity)
+
+    def test_order_repeated_in_one_bulk_post_is_created_once(self):
+        results = stream_lines(self.post_ndjson(ndjson(self.orders[:2] + self.orders[:1])))
+
+        expected = ["created", "created", "replayed"]
+        self.assertEqual(expected, [result["status"] for result in results])
+        self.assertEqual(2, len(Order.objects.all()))
+
+    def test_malformed_line_in_bulk_post_reports_error_in_place(self):
+        body = ndjson(self.orders[:1]) + "not json\n" + ndjson(self.orders[1:2])
+
+        results = stream_lines(self.post_ndjson(body))
+
+        expected = [("700", "created"), (None, "error"), ("701", "created")]
+        self.assertEqual(expected, [(result["order_id"], result["status"]) for result in results])
+
+
+class TestListViews(TestCase):
+    def setUp(self):
+        init_catalog(product_info)
+        self.client = APIClient()
+        for order_id in range(5):
+            Order.objects.create(id=f"order-{order_id}")
+
+    def test_orders_are_listed_a_page_at_a_time(self):
+        first = self.client.get("/api/orders", {"page_size": 2}).json()
+        second = self.client.get(first["next"]).json()
+
+        self.assertEqual(["order-0", "order-1"], [order["id"] for order in first["results"]])
+        self.assertEqual(["order-2", "order-3"], [order["id"] for order in second["results"]])
+
+    def test_page_size_is_capped(self):
+        with patch.object(KeysetPagination, "max_page_size", 3):
+            response = self.client.get("/api/orders", {"page_size": 100}).json()
+
+        self.assertEqual(3, len(response["results"]))
+
+    def test_inventory_is_paginated(self):
+        response = self.client.get("/api/inventory", {"page_size": 5}).json()
+
+        self.assertEqual(5, len(response["results"]))
+        self.assertIsNotNone(response["next"])
+
+    def test_orders_stream_as_json_array(self):
+        response = self.client.get("/api/orders", {"stream": "json"})
+
+        orders = json.loads(b"".join(response.streaming_content))
+        self.assertEqual([f"order-{order_id}" for order_id in range(5)], [order["id"] for order in orders])
+
+    def test_inventory_streams_as_ndjson(self):
+        response = self.client.get("/api/inventory", {"stream": "ndjson"})
+
+        self.assertEqual("application/x-ndjson", response["Content-Type"])
+        self.assertEqual(len(product_info), len(stream_lines(response)))
+
+    def test_empty_table_streams_empty_array(self):
+        Order.objects.all().delete()
+
+        response = self.client.get("/api/orders", {"stream": "json"})
+
+        self.assertEqual([], json.loads(b"".join(response.streaming_content)))
+
+    def test_unknown_stream_format_is_rejected(self):
+        response = self.client.get("/api/orders", {"stream": "xml"})
+
+        self.assertEqual(400, response.status_code)
+
+
+class TestOrderDetails(TestCase):
+    def setUp(self):
+        init_catalog(product_info)
+        self.client = APIClient()
+        process_restock([{"product_id": 0, "quantity": 2}])
+        self.client.post("/api/orders", {
+            "order_id": 123,
+            "requested": [{"product_id": 0, "quantity": 2}, {"product_id": 10, "quantity": 4}]
+        }, format="json")
+
+    def test_order_detail_has_items_and_shipments(self):
+        response = self.client.get("/api/orders/123").json()
+
+        self.assertEqual(["0", "10"], [item["product"] for item in response["items"]])
+        self.assertEqual([0, 4], [item["quantity_needed"] for item in response["items"]])
+        self.assertEqual(1, len(response["shipments"]))
+        self.assertEqual(1400, response["shipments"][0]["mass_g"])
+        self.assertEqual([{"product": "0", "quantity": 2}],
+                         [{"product": item["product"], "quantity": item["quantity"]}
+                          for item in response["shipments"][0]["items"]])
+
+    def test_unknown_order_detail_is_not_found(self):
+        response = self.client.get("/api/orders/999")
+
+        self.assertEqual(404, response.status_code)
+
+    def test_detailed_page_costs_same_queries_for_any_number_of_items(self):
+        with self.assertNumQueries(4):
+            self.client.get("/api/orders", {"detail": "true"})
+
+        process_restock([{"product_id": 0, "quantity": 10}, {"product_id": 10, "quantity": 10}])
+        for order_id in range(5):
+            self.client.post("/api/orders", {
+                "order_id": order_id,
+                "requested": [{"product_id": 0, "quantity": 1}, {"product_id": 10, "quantity": 2},
+                              {"product_id": 6, "quantity": 1}]
+            }, format="json")
+
+        with self.assertNumQueries(4):
+            response = self.client.get("/api/orders", {"detail": "true"}).json()
+        self.assertEqual(6, len(response["results"]))
+
+    def test_detailed_stream_prefetches_per_chunk(self):
+        with self.assertNumQueries(4):
+            response = self.client.get("/api/orders", {"detail": "true", "stream": "ndjson"})
+            orders = stream_lines(response)
+
+        self.assertEqual(2, len(orders[0]["items"]))
+
+
+class TestShipmentPlanView(TestCase):
+    def setUp(self):
+        init_catalog(product_info)
+        self.client = APIClient()
+        process_restock([{"product_id": 0, "quantity": 3}, {"product_id": 10, "quantity": 4}])
+        self.test_order = {
+            "order_id": 123,
+            "requested": [{"product_id": 0, "quantity": 4}, {"product_id": 10, "quantity": 4}]
+        }
+
+    def test_plan_lists_packages_and_backordered_items(self):
+        response = self.client.post("/api/plan", self.test_order, format="json")
+
+        self.assertEqual(200, response.status_code)
+        plan = response.json()
+        # 3 * 700 g and 4 * 300 g in two packages under 1800 g
+        self.assertEqual([1600, 1700], sorted(package["mass_g"] for package in plan["packages"]))
+        self.assertEqual({"0": 3, "10": 4}, {
+            product_id: sum(item["quantity"] for package in plan["packages"] for item in package["items"]
+                            if item["product_id"] == product_id)
+            for product_id in ("0", "10")
+        })
+        self.assertEqual([{"product_id": "0", "quantity": 1}], plan["backordered"])
+
+    def test_plan_writes_nothing(self):
+        self.client.post("/api/plan", self.test_order, format="json")
+
+        self.assertEqual(0, Order.objects.count())
+        self.assertEqual(0, Shipment.objects.count())
+        self.assertEqual(3, ProductInventory.objects.get(product_id=0).quantity)
+
+    def test_plan_matches_what_the_order_then_ships(self):
+        plan = self.client.post("/api/plan", self.test_order, format="json").json()
+
+        self.client.post("/api/orders", self.test_order, format="json")
+
+        shipments = Shipment.objects.filter(order_id=123)
+        self.assertEqual(sorted(package["mass_g"] for package in plan["packages"]),
+                         sorted(shipment.total_mass for shipment in shipments))
+
+    def test_plan_sees_stock_taken_by_another_process(self):
+        self.client.post("/api/plan", self.test_order, format="json")
+        # a reservation written by another worker, which this process's cache never hears of
+        InventoryMovement.objects.create(product_id="0", kind=InventoryMovement.RESERVE, quantity=3, delta=-3)
+
+        plan = self.client.post("/api/plan", self.test_order, format="json").json()
+
+        self.assertEqual([{"product_id": "0", "quantity": 4}], plan["backordered"])
+
+    def test_plan_with_warm_caches_reads_only_version_and_stock(self):
+        self.client.post("/api/plan", self.test_order, format="json")
+
+        with self.assertNumQueries(2):
+            self.client.post("/api/plan", self.test_order, format="json")
+
+    def test_plan_with_unknown_product_is_rejected(self):
+        response = self.client.post("/api/plan", {
+            "order_id": 1, "requested": [{"product_id": 100, "quantity": 1}]
+        }, format="json")
+
+        self.assertEqual(400, response.status_code)
+
+
+class TestAsyncViews(TransactionTestCase):
+    # database work runs on pool threads with connections of their own, which cannot see a test transaction
+
+    def setUp(self):
+        init_catalog(product_info)
+        idempotency.clear()
+        self.addCleanup(idempotency.clear)
+        # shipments really commit here, keep their records out of the test output
+        patcher = patch("nest_app.shipment_log.emit")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = AsyncClient()
+        self.test_order = {
+            "order_id": 123,
+            "requested": [{"product_id": 0, "quantity": 2}, {"product_id": 10, "quantity": 4}]
+        }
+
+    async def test_post_order_creates_order(self):
+        response = await self.client.post("/api/async/orders", self.test_order, content_type="application/json")
+
+        self.assertEqual(201, response.status_code)
+        self.assertEqual("pending", response.json()["status"])
+
+    async def test_retried_order_returns_original_result(self):
+        first = await self.client.post("/api/async/orders", self.test_order, content_type="application/json")
+        response = await self.client.post("/api/async/orders", self.test_order, content_type="application/json")
+
+        self.assertEqual(first.json(), response.json())
+        self.assertEqual("true", response["Idempotent-Replayed"])
+
+    async def test_invalid_order_is_rejected(self):
+        response = await self.client.post("/api/async/orders", "not json", content_type="application/json")
+
+        self.assertEqual(400, response.status_code)
+
+    async def test_restock_ships_pending_orders(self):
+        await self.client.post("/api/async/orders", self.test_order, content_type="application/json")
+
+        response = await self.client.post("/api/async/inventory", [
+            {"product_id": 0, "quantity": 2}, {"product_id": 10, "quantity": 4}
+        ], content_type="application/json")
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({0}, {row["quantity"] for row in response.json()})
+        self.assertTrue(await database_sync_to_async(lambda: Order.objects.get(id=123).completed)())
+
+    async def test_restock_with_unknown_product_is_rejected(self):
+        response = await self.client.post("/api/async/inventory", [{"product_id": 100, "quantity": 1}],
+                                          content_type="application/json")
+
+        self.assertEqual(400, response.status_code)
+
+    async def test_inventory_is_listed_a_page_at_a_time(self):
+        first = (await self.client.get("/api/async/inventory?page_size=10")).json()
+        next_url = urlsplit(first["next"])
+        second = (await self.client.get(f"{next_url.path}?{next_url.query}")).json()
+
+        self.assertEqual(10, len(first["results"]))
+        self.assertEqual(len(product_info) - 10, len(second["results"]))
+        self.assertIsNone(second["next"])
+
+    async def test_concurrent_requests_share_the_pool(self):
+        responses = await asyncio.gather(*[
+            self.client.get("/api/async/orders?page_size=5") for _ in range(20)
+        ])
+
+        self.assertEqual({200}, {response.status_code for response in responses})
+
+    async def test_unsupported_method(self):
+        response = await self.client.delete("/api/async/orders")
+
+        self.assertEqual(405, response.status_code)
+
+
+@override_settings(NEST_METRICS_ENABLED=True)
+class TestMetricsView(TestCase):
+    def setUp(self):
+        init_catalog(product_info)
+        metrics.registry.reset()
+        self.client = APIClient()
+        process_restock([{"product_id": 0, "quantity": 30}])
+
+    def test_metrics_report_queries_and_shipments_per_operation(self):
+        self.client.post("/api/orders", {"order_id": 1, "requested": [{"product_id": 0, "quantity": 4}]}, format="json")
+
+        body = self.client.get("/api/metrics").content.decode()
+
+        self.assertIn('nest_operation_duration_seconds_count{operation="process_order"} 1', body)
+        self.assertIn('nest_operation_shipments_sum{operation="process_order"} 2', body)
+        self.assertIn('nest_operation_queries_count{operation="api.orders.post"} 1', body)
+
+    def test_failed_calls_are_counted(self):
+        self.client.post("/api/orders", {"order_id": 2, "requested": [{"product_id": 100, "quantity": 1}]}, format="json")
+
+        body = self.client.get("/api/metrics").content.decode()
+
+        self.assertIn('nest_operation_errors_total{operation="process_order"} 1', body)
+
+    @override_settings(NEST_METRICS_ENABLED=False)
+    def test_nothing_recorded_when_disabled(self):
+        self.client.post("/api/orders", {"order_id": 3, "requested": [{"product_id": 0, "quantity": 1}]}, format="json")
+
+        body = self.client.get("/api/metrics").content.decode()
+
+        self.assertNotIn('operation="process_order"', body)
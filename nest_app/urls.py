@@ -1,12 +1,17 @@
 from django.urls import path, include
 from rest_framework import routers
 
-from . import views
+from . import async_views, views
 
 router = routers.DefaultRouter()
 
 urlpatterns = [
     path('', include(router.urls), name="view_sets"),
     path(r"orders", views.OrdersView.as_view()),
+    path(r"orders/<str:pk>", views.OrderDetailView.as_view()),
     path(r"inventory", views.ProductInventoryView.as_view()),
+    path(r"plan", views.ShipmentPlanView.as_view()),
+    path(r"metrics", views.metrics_view),
+    path(r"async/orders", async_views.orders),
+    path(r"async/inventory", async_views.inventory),
 ]
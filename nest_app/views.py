@@ -1,30 +1,252 @@
-from rest_framework.generics import ListCreateAPIView
+import json
+from itertools import islice
 
-from . import models
-from .serializers import ProductInventorySerializer, OrdersSerializer
+from django.db import IntegrityError
+from django.db.models import prefetch_related_objects
+from django.http import HttpResponse, StreamingHttpResponse
+from rest_framework import status
+from rest_framework.generics import ListCreateAPIView, RetrieveAPIView
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.views import APIView
 
+from . import idempotency, metrics, models
+from .pagination import KeysetPagination
+from .processing import (
+    REQUEST_ERRORS, plan_order, process_orders, process_restock, request_error_detail, submit_order
+)
+from .serializers import (
+    ProductInventorySerializer, OrdersSerializer, OrderDetailSerializer, OrderRequestSerializer, RestockItemSerializer
+)
 
-class ProductInventoryView(ListCreateAPIView):
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+# orders parsed from a bulk NDJSON body before they are processed together
+ORDER_STREAM_CHUNK_SIZE = 500
+
+# rows fetched per round trip when a list is streamed
+LIST_STREAM_CHUNK_SIZE = 2000
+LIST_STREAM_FORMATS = ("json", "ndjson")
+
+
+class KeysetListMixin:
+    """GET lists one cursor page at a time, or streams every row with ?stream=json or ?stream=ndjson
+
+    Either way the response holds a bounded number of rows in memory whatever the size of the table.
+    """
+
+    pagination_class = KeysetPagination
+
+    def list(self, request, *args, **kwargs):
+        stream_format = request.query_params.get("stream")
+        if stream_format is None:
+            return super().list(request, *args, **kwargs)
+        if stream_format not in LIST_STREAM_FORMATS:
+            return Response({"detail": f"stream must be one of {', '.join(LIST_STREAM_FORMATS)}."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = self.filter_queryset(self.get_queryset()).order_by(self.pagination_class.ordering)
+        rows = stream_rows(queryset, self.get_serializer(), stream_format == "ndjson")
+        content_type = NDJSON_CONTENT_TYPE if stream_format == "ndjson" else "application/json"
+        return StreamingHttpResponse(rows, content_type=content_type)
+
+
+class ProductInventoryView(KeysetListMixin, ListCreateAPIView):
     queryset = models.ProductInventory.objects.all()
     serializer_class = ProductInventorySerializer
 
     # view current inventory
+    @metrics.instrument("api.inventory.get")
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
 
-    # restock
+    # restock, adding each quantity to the current stock
+    @metrics.instrument("api.inventory.post")
     def post(self, request, *args, **kwargs):
-        pass
+        restock_request = RestockItemSerializer(data=request.data, many=True, allow_empty=False)
+        restock_request.is_valid(raise_exception=True)
+
+        try:
+            inventory_products = process_restock(restock_request.validated_data)
+        except REQUEST_ERRORS as e:
+            return Response({"detail": request_error_detail(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(self.get_serializer(inventory_products, many=True).data)
 
 
-class OrdersView(ListCreateAPIView):
+class OrdersView(KeysetListMixin, ListCreateAPIView):
     queryset = models.Order.objects.all()
     serializer_class = OrdersSerializer
 
-    # current orders
+    def detailed(self):
+        return self.request.method == "GET" and self.request.query_params.get("detail") in ("1", "true")
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        return queryset.with_details() if self.detailed() else queryset
+
+    def get_serializer_class(self):
+        return OrderDetailSerializer if self.detailed() else OrdersSerializer
+
+    # current orders, with their items and shipments when ?detail=true
+    @metrics.instrument("api.orders.get")
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
 
-    # create order
+    # create order, or many orders when the body is NDJSON
+    @metrics.instrument("api.orders.post")
+    def post(self, request, *args, **kwargs):
+        if request.content_type.split(";")[0].strip() == NDJSON_CONTENT_TYPE:
+            # iterate the underlying Django request so the body is read line by line, not buffered
+            results = stream_order_results(iter(request._request), ORDER_STREAM_CHUNK_SIZE)
+            return StreamingHttpResponse(results, content_type=NDJSON_CONTENT_TYPE)
+
+        order_request = OrderRequestSerializer(data=request.data)
+        order_request.is_valid(raise_exception=True)
+
+        # a retried request gets the original result back without being processed again
+        try:
+            entry, replayed = submit_order(order_request.validated_data, request.headers.get("Idempotency-Key"))
+        except REQUEST_ERRORS as e:
+            return Response({"detail": request_error_detail(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except IntegrityError:
+            return Response({"detail": "Order already exists."}, status=status.HTTP_409_CONFLICT)
+
+        return Response(entry.result, status=entry.status_code, headers=idempotency.replay_headers(replayed))
+
+
+class OrderDetailView(RetrieveAPIView):
+    queryset = models.Order.objects.with_details()
+    serializer_class = OrderDetailSerializer
+
+    # one order with its items and shipments
+    @metrics.instrument("api.order.get")
+    def get(self, request, *args, **kwargs):
+        return self.retrieve(request, *args, **kwargs)
+
+
+class ShipmentPlanView(APIView):
+    # how an order would ship against current stock: packages and backordered items, nothing is written
+    @metrics.instrument("api.plan.post")
     def post(self, request, *args, **kwargs):
+        order_request = OrderRequestSerializer(data=request.data)
+        order_request.is_valid(raise_exception=True)
+
+        try:
+            plan = plan_order(order_request.validated_data)
+        except REQUEST_ERRORS as e:
+            return Response({"detail": request_error_detail(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(plan)
+
+
+# Prometheus scrape endpoint
+def metrics_view(request):
+    return HttpResponse(metrics.registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def stream_rows(queryset, serializer, ndjson):
+    """Serialize rows as they come off the database cursor, as a JSON array or one JSON object per line
+
+    iterator() skips prefetch_related, so any prefetches of the queryset are run once per chunk of rows instead.
+    """
+
+    encoder = JSONEncoder(separators=(",", ":"))
+    lookups = queryset._prefetch_related_lookups
+    rows = queryset.prefetch_related(None).iterator(chunk_size=LIST_STREAM_CHUNK_SIZE)
+    if not ndjson:
+        yield b"["
+    first = True
+    for chunk in iter(lambda: list(islice(rows, LIST_STREAM_CHUNK_SIZE)), []):
+        if lookups:
+            prefetch_related_objects(chunk, *lookups)
+        for row in chunk:
+            text = encoder.encode(serializer.to_representation(row))
+            if ndjson:
+                yield (text + "\n").encode()
+            else:
+                yield (text if first else "," + text).encode()
+            first = False
+    if not ndjson:
+        yield b"]"
+
+
+def stream_order_results(lines, chunk_size):
+    """Parse NDJSON order lines, process them in chunks and yield one NDJSON result line per order"""
+
+    chunk = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            order_request = OrderRequestSerializer(data=json.loads(line))
+            valid = order_request.is_valid()
+        except ValueError:
+            valid = False
+            order_request = None
+
+        if not valid:
+            # flush what came before so result lines stay in request order
+            yield from _process_order_chunk(chunk)
+            chunk = []
+            errors = order_request.errors if order_request is not None else "Invalid JSON."
+            yield _result_line(None, "error", errors)
+            continue
+
+        chunk.append(order_request.validated_data)
+        if len(chunk) >= chunk_size:
+            yield from _process_order_chunk(chunk)
+            chunk = []
+
+    yield from _process_order_chunk(chunk)
+
+
+def _process_order_chunk(orders):
+    if not orders:
+        return []
+
+    keys = [idempotency.request_key(order["order_id"]) for order in orders]
+    entries = idempotency.lookup_many(keys)
+    results = [
+        _replay_line(order, entries[key]) if key in entries else None
+        for order, key in zip(orders, keys)
+    ]
+    new = [(index, order, key) for index, (order, key) in enumerate(zip(orders, keys)) if key not in entries]
+    if not new:
+        return results
+
+    try:
+        process_orders([order for _, order, _ in new], [key for _, _, key in new])
+        for index, order, _ in new:
+            results[index] = _result_line(order["order_id"], "created")
+        return results
+    except Exception:
         pass
+
+    # one bad order rolls back its whole chunk, so retry the orders on their own to isolate it
+    for index, order, _ in new:
+        try:
+            # an order already created, earlier in this chunk or by another request, is replayed
+            _, replayed = submit_order(order)
+            results[index] = _result_line(order["order_id"], "replayed" if replayed else "created")
+        except IntegrityError:
+            results[index] = _result_line(order["order_id"], "error", "Order already exists.")
+        except Exception as e:
+            detail = request_error_detail(e) or str(e) or e.__class__.__name__
+            results[index] = _result_line(order["order_id"], "error", detail)
+    return results
+
+
+def _replay_line(order, entry):
+    if entry.fingerprint != idempotency.fingerprint(order):
+        return _result_line(order["order_id"], "error", "Order already exists.")
+    return _result_line(order["order_id"], "replayed")
+
+
+def _result_line(order_id, result, detail=None):
+    line = {"order_id": order_id, "status": result}
+    if detail is not None:
+        line["detail"] = detail
+    return (json.dumps(line) + "\n").encode()
@@ -85,6 +85,70 @@ DATABASES = {
     }
 }
 
+# PRAGMAs applied to every new SQLite connection (nest_app.db.apply_storage_profile).
+# NEST_STORAGE_PROFILE is the name of one of NEST_STORAGE_PROFILES, or a dict of PRAGMAs.
+NEST_STORAGE_PROFILE = 'throughput'
+
+NEST_STORAGE_PROFILES = {
+    # SQLite defaults: rollback journal, fsync on every commit
+    'default': {},
+    # WAL lets readers run alongside the writer; synchronous=NORMAL only fsyncs at checkpoints
+    'throughput': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -64000,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+    },
+    # WAL with an fsync on every commit
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+    },
+}
+
+# 'inline' ships available items while the order is submitted; 'outbox' only commits the order with a
+# FulfillmentTask that `manage.py run_fulfillment_worker` picks up.
+NEST_FULFILLMENT_MODE = 'inline'
+
+# how restocked stock is shared out among pending items: 'fifo', 'smallest_first' or 'max_completed_orders'
+NEST_ALLOCATION_POLICY = 'fifo'
+
+# 'consolidated' packs the items a restock frees for one order into as few shipments as possible across all
+# restocked products; 'per_item' ships every freed item on its own
+NEST_RESTOCK_SHIPMENTS = 'consolidated'
+
+# order results kept in memory for replaying retried requests; older ones are read back from the database
+NEST_IDEMPOTENCY_CACHE_SIZE = 10000
+
+# inventory movements recorded before they are folded into snapshots, after a restock or by an idle
+# fulfillment worker; 0 leaves snapshots to the snapshot_inventory command
+NEST_INVENTORY_SNAPSHOT_INTERVAL = 1000
+
+# threads (and so at most this many database connections per process) the async endpoints run database work on
+NEST_DB_THREADS = 8
+
+# worker processes started by run_fulfillment_worker
+NEST_FULFILLMENT_WORKERS = 2
+
+# seconds before a task claimed by a worker that never finished it goes back to the outbox
+NEST_FULFILLMENT_CLAIM_TIMEOUT = 300
+
+# shipment event log (nest_app.shipment_log): "json" records or the "text" manifest, to stdout when path
+# is None, written in batches from a background thread
+NEST_SHIPMENT_LOG = {
+    'format': 'json',
+    'path': None,
+    'max_queue': 10000,
+    'batch_size': 500,
+    'flush_interval': 1.0,
+    'max_bytes': 10 * 1024 * 1024,
+    'backup_count': 5,
+}
+
+# per-call query count, query time, wall time and shipment histograms, served at /api/metrics
+NEST_METRICS_ENABLED = True
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators